@@ -1,5 +1,8 @@
 #-*- coding:utf-8 -*-
+import time
 import datetime
+import hashlib
+import threading
 
 from flask import render_template, request, jsonify, redirect, url_for
 from flask_login import current_user, login_user, logout_user, login_required 
@@ -12,6 +15,10 @@ from pdglig.graphdb_neo4j.user import User
 
 from app import app, graphdb, mail, bcrypt, hash_pass
 
+from pdgapi.cache import LRUCache
+from pdgapi.mailer import MailDispatcher
+from pdgapi.executor import ProcessExecutor, ExecutorBusy, ExecutorTimeout, ExecutorError
+
 
 
 infos = {
@@ -30,6 +37,181 @@ USER_ACCOUNT_LIMIT = app.config['USER_ACCOUNT_LIMIT']
 
 serialiser = URLSafeTimedSerializer(app.config['SECRET_KEY'])
 
+# mails are sent in background, MAIL_SINK "memory" or a file path to test
+# without a mail server
+mailer = MailDispatcher(app, mail,
+                        sink=app.config.get("MAIL_SINK", "smtp"),
+                        path=app.config.get("MAIL_SPOOL", None),
+                        workers=app.config.get("MAIL_WORKERS", 1),
+                        retries=app.config.get("MAIL_RETRIES", 5) )
+
+# user records by ('email', email) and ('login', username). Unknown users are
+# not cached: another process may create them, and signup checks rely on it
+users = LRUCache(max_entries=app.config.get("USER_CACHE_SIZE", 10000),
+                 ttl=app.config.get("USER_CACHE_TTL", 60))
+
+def user_record(key, value):
+    """ cached (uuid, username, email, password, active) of a user, () if none
+    :param key: 'email' or 'login'
+    """
+    record = users.get((key, value))
+    if record is None:
+        lookup = User.get_by_email if key == "email" else User.get_by_login
+        u = lookup(graphdb.db, value)
+        record = ()
+        if u:
+            record = ( u.node['uuid'],
+                       u.node['username'],
+                       u.node['email'],
+                       u.node['password'],
+                       u.node['active'],
+                     )
+            users.set(('login', record[1]), record, size=1)
+            users.set(('email', record[2]), record, size=1)
+            users.set((key, value), record, size=1)
+    return record
+
+# verified auth tokens by (email, password fingerprint) : user record
+tokens = LRUCache(max_entries=app.config.get("TOKEN_CACHE_SIZE", 10000),
+                  ttl=app.config.get("TOKEN_CACHE_TTL", 60))
+# (email, password fingerprint) of the tokens revoked by a password change,
+# kept as long as these tokens could be valid
+revoked = LRUCache(max_entries=app.config.get("TOKEN_CACHE_SIZE", 10000),
+                   ttl=AUTH_TOKEN_MAX_AGE)
+
+def fingerprint(password):
+    return hashlib.sha1(password.encode('utf8') if isinstance(password, unicode) else password).hexdigest()
+
+def revoke_tokens(email, password):
+    """ makes the tokens issued for `password` fail at once """
+    revoked.set((email, fingerprint(password)), True, size=1)
+    tokens.discard(lambda key: key[0] == email)
+
+# bcrypt runs in worker processes, a few at a time
+hasher = ProcessExecutor(workers=app.config.get("BCRYPT_WORKERS", 2),
+                         max_queue=app.config.get("BCRYPT_QUEUE", 16),
+                         timeout=app.config.get("BCRYPT_TIMEOUT", 10.))
+hasher.register("check_password", bcrypt.check_password_hash)
+# raised by `hasher` when it is saturated or its worker fails
+HASHING_ERRORS = (ExecutorBusy, ExecutorTimeout, ExecutorError)
+
+
+class TooManyAttempts(Exception):
+    pass
+
+class AttemptThrottle(object):
+    """ Counts failed login attempts per key in a sliding `window` of seconds,
+    `check` raises `TooManyAttempts` beyond `limit` """
+
+    def __init__(self, limit, window, max_entries=100000):
+        self.limit = limit
+        self.window = window
+        self.attempts = LRUCache(max_entries=max_entries, ttl=window)
+        self.rejected = 0
+
+    def recent(self, key):
+        now = time.time()
+        return [ t for t in self.attempts.get(key, (), count=False) if t > now - self.window ]
+
+    def check(self, key):
+        if key is None or self.limit <= 0 : return
+        if len(self.recent(key)) >= self.limit:
+            self.rejected += 1
+            raise TooManyAttempts("too many login attempts")
+
+    def failure(self, key):
+        """ records a failed attempt """
+        if key is None or self.limit <= 0 : return
+        self.attempts.set(key, tuple(self.recent(key)) + (time.time(),), size=1)
+
+    def reset(self, key):
+        self.attempts.pop(key)
+
+    def stats(self):
+        return { 'tracked': len(self.attempts), 'rejected': self.rejected }
+
+account_attempts = AttemptThrottle(app.config.get("LOGIN_ATTEMPTS_PER_ACCOUNT", 10),
+                                   app.config.get("LOGIN_ATTEMPTS_WINDOW", 300))
+ip_attempts = AttemptThrottle(app.config.get("LOGIN_ATTEMPTS_PER_IP", 50),
+                              app.config.get("LOGIN_ATTEMPTS_WINDOW", 300))
+
+def client_ip(request):
+    """ address of the client, read from the LOGIN_IP_HEADER header set by
+    the TRUSTED_PROXIES in front of the app """
+    proxies = app.config.get("TRUSTED_PROXIES", ())
+    addr = request.remote_addr
+    if addr not in proxies:
+        return addr
+    forwarded = request.headers.get(app.config.get("LOGIN_IP_HEADER", "X-Forwarded-For"), "")
+    # the last address not added by a trusted proxy
+    for hop in reversed([ a.strip() for a in forwarded.split(",") if a.strip() ]):
+        if hop not in proxies:
+            return hop
+    return addr
+
+
+class UserCounter(object):
+    """ Number of users, loaded once, adjusted by the accounts created here
+    and reconciled with the db every `interval` seconds in background """
+
+    def __init__(self, load, interval=60.):
+        self.load = load
+        self.interval = interval
+        self.count = None
+        self.reconciled = None
+        self._lock = threading.Lock()
+        self._thread = None
+
+    def get(self):
+        if self.count is None:
+            self.reconcile()
+        self._start()
+        return self.count
+
+    def add(self, value=1):
+        with self._lock:
+            if self.count is not None:
+                self.count += value
+
+    def reconcile(self):
+        count = self.load()
+        with self._lock:
+            self.count = count
+            self.reconciled = time.time()
+
+    def stats(self):
+        return { 'count': self.count,
+                 'age': time.time() - self.reconciled if self.reconciled else None }
+
+    def _start(self):
+        if self._thread is not None or self.interval <= 0:
+            return
+        with self._lock:
+            if self._thread is None:
+                self._thread = threading.Thread(target=self._work, name="user-counter")
+                self._thread.daemon = True
+                self._thread.start()
+
+    def _work(self):
+        while True:
+            time.sleep(self.interval)
+            try:
+                self.reconcile()
+            except Exception as e:
+                print "can't count users", e
+
+user_counter = UserCounter(graphdb.get_users_count, app.config.get("USER_COUNT_INTERVAL", 60))
+
+
+def forget_user(email=None, username=None):
+    """ drops the cached records of a user """
+    for key, value in (('email', email), ('login', username)):
+        if value is None: continue
+        record = users.pop((key, value))
+        if record:
+            users.pop(('login', record[1]))
+            users.pop(('email', record[2]))
+
 
 
 
@@ -46,7 +228,10 @@ class PdgUser:
 
     @staticmethod     
     def create(login, email, password):
-        return graphdb.create_user(login, email, hash_pass(password), False  )
+        created = graphdb.create_user(login, email, hasher.run(hash_pass, password), False  )
+        user_counter.add(1)
+        forget_user(email, login)
+        return created
 
     
     @staticmethod     
@@ -58,14 +243,14 @@ class PdgUser:
         
         user = User.get_by_email(graphdb.db, email)
         user.activate()
+        forget_user(email)
         return PdgUser.get_by_email(email)
         
     @staticmethod     
     def has_username(username):
         try :
             if username is not None:        
-                u = User.get_by_login(graphdb.db, username)
-                return True
+                return len(user_record('login', username)) > 0
         except :
             return False
             
@@ -73,8 +258,7 @@ class PdgUser:
     def has_email(email):
         try :
             if email is not None:        
-                u = User.get_by_email(graphdb.db, email)
-                return True
+                return len(user_record('email', email)) > 0
         except :
             return False
             
@@ -83,14 +267,9 @@ class PdgUser:
         user = None
         if username is not None:        
             
-            u = User.get_by_login(graphdb.db, username)
-            if u:
-                user = PdgUser(u.node['uuid'],
-                               u.node['username'],
-                               u.node['email'],
-                               u.node['password'],
-                               u.node['active'],
-                              )
+            record = user_record('login', username)
+            if record:
+                user = PdgUser(*record)
         return user
         
         #raise UserLoginNotFoundError('login: %s' % login)
@@ -100,14 +279,9 @@ class PdgUser:
         user = None
         if email is not None:        
             
-            u = User.get_by_email(graphdb.db, email)
-            if u:
-                user = PdgUser(u.node['uuid'],
-                               u.node['username'],
-                               u.node['email'],
-                               u.node['password'], # may we return **** ?
-                               u.node['active'],
-                              )
+            record = user_record('email', email)
+            if record:
+                user = PdgUser(*record) # may we hide the password ?
         return user
         
         #raise UserLoginNotFoundError('login: %s' % login)
@@ -129,20 +303,37 @@ class PdgUser:
     @staticmethod     
     def change_password( email, password):
         u = User.get_by_email(graphdb.db, email)
-        hash_password = hash_pass(password)
+        previous = u.node['password']
+        hash_password = hasher.run(hash_pass, password)
         u.update_password(hash_password)
+        if previous:
+            revoke_tokens(email, previous)
+        forget_user(email)
         return True
 
     @staticmethod
     def from_token(token):
-        """ authenticate a user using encrypted token """
+        """ authenticate a user using encrypted token
+        tokens verified recently are accepted without reading the user
+        """
         
         try :
             email, password  = serialiser.loads(token,max_age=AUTH_TOKEN_MAX_AGE)
+            key = (email, fingerprint(password))
+            if key in revoked:
+                return None
+
+            record = tokens.get(key)
+            if record is not None:
+                user = PdgUser(*record)
+                user._verified = True
+                return user
+
             user = PdgUser.get_by_email(email)
             user.verify_password(password, hashed=True)
             
             if user and user.is_active() and user.is_authenticated(): 
+                tokens.set(key, (user.uuid, user.username, user.email, user.password, user.active), size=1)
                 return user
         except:
             raise
@@ -154,7 +345,8 @@ class PdgUser:
         if hashed:
             self._verified = self.password is not None and self.password == password
         else:
-            self._verified = bcrypt.check_password_hash(self.password, password)
+            self._verified = self.password is not None \
+                and hasher.run("check_password", self.password, password)
 
         # TODO raise password exception
         
@@ -359,8 +551,8 @@ def noreply_send(subject, to, body):
         message.recipients = [to]
         message.body = body
         message.subject = subject
-        print "sending message", subject
-        mail.send(message)
+        print "queuing message", subject
+        mailer.send(message)
     except Exception as err:
         raise SendMailError(to, err)
 
@@ -428,6 +620,10 @@ def send_password_recovery_link(email, hashed_password ):
 
 
 def authenticate_user(request):
+    """ :returns: the user matching the credentials of the request or None
+    raises `TooManyAttempts` before any hashing when the account or the
+    client made too many failed attempts
+    """
     if request.method == 'POST':
 
         username = request.form.get('username', None )
@@ -438,13 +634,31 @@ def authenticate_user(request):
             username = request.json.get('username', None )
             email = request.json.get('email', None )
             password = request.json.get('password', None )
-                    
-        return PdgUser.authenticate(email, password, hashed=False)
 
     elif request.method == 'GET': 
         email = request.args['email']
         password = request.args['password']
-        return PdgUser.authenticate(email, password, hashed=False)
+
+    ip = client_ip(request)
+    ip_attempts.check(ip)
+    account_attempts.check(email)
+    user = PdgUser.authenticate(email, password, hashed=False)
+    if user:
+        account_attempts.reset(email)
+    else :
+        ip_attempts.failure(ip)
+        account_attempts.failure(email)
+    return user
+
+def login_failure(err):
+    """ response to a rejected or overloaded login """
+    if isinstance(err, TooManyAttempts):
+        return "too many login attempts", 429
+    return unavailable("login")
+
+def unavailable(action):
+    """ response to an action the overloaded `hasher` could not serve """
+    return "%s unavailable, retry later" % action, 503
         
 
 def users_api(name):
@@ -466,7 +680,10 @@ def users_api(name):
 
     @api.route("/authenticate", methods=['GET', 'POST'])
     def auth():
-        user = authenticate_user(request)
+        try:
+            user = authenticate_user(request)
+        except (TooManyAttempts,) + HASHING_ERRORS as err:
+            return login_failure(err)
             
         if user:
             return jsonify({
@@ -498,7 +715,10 @@ def users_api(name):
         print ">>>>>>> login"
 
         
-        user = authenticate_user(request)
+        try:
+            user = authenticate_user(request)
+        except (TooManyAttempts,) + HASHING_ERRORS as err:
+            return login_failure(err)
 
         print request, user
         
@@ -555,7 +775,7 @@ def users_api(name):
         has_error = False
 
         if USER_ACCOUNT_LIMIT > 0:
-            if graphdb.get_users_count() >= USER_ACCOUNT_LIMIT:
+            if user_counter.get() >= USER_ACCOUNT_LIMIT:
                 raise UserAccountLimitException()
 
         form = CreateUserForm()
@@ -576,7 +796,10 @@ def users_api(name):
                 email = form.email.data
                 password = form.password.data
                 
-                login = PdgUser.create( username, email, password )
+                try:
+                    login = PdgUser.create( username, email, password )
+                except HASHING_ERRORS:
+                    return unavailable("account creation")
 
                 send_activation_link(email)
 
@@ -681,6 +904,8 @@ def users_api(name):
                     return render_template('account-recovery.html' , step="password-changed" )
                     
                 return render_template('account-recovery.html' , step="password-form", token=token, email=email, has_error=True, errors=form.errors )
+        except HASHING_ERRORS:
+            return unavailable("password change")
         except :
             return render_template('account-recovery.html' , step="token-invalid" )
 
@@ -697,12 +922,25 @@ def users_api(name):
 
 
 
+    @api.route("/stats", methods=['GET'])
+    def stats():
+        """ account caches counters """
+        return jsonify( { "users": users.stats(),
+                          "tokens": tokens.stats(),
+                          "revoked": len(revoked),
+                          "mails": mailer.stats(),
+                          "users_count": user_counter.stats(),
+                          "hashing": hasher.stats(),
+                          "login_attempts": { 'accounts': account_attempts.stats(),
+                                              'ips': ip_attempts.stats() },
+                        } )
+
     @api.route("/count", methods=['GET'])
     #@login_required
     def users_count():
         """ Get users count """
         print "count"
-        count = graphdb.get_users_count()
+        count = user_counter.get()
         return jsonify( { "count" : count } )
 
 
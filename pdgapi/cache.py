@@ -0,0 +1,708 @@
+#-*- coding:utf-8 -*-
+""" In process caches shared by the apis """
+
+import os
+import time
+import uuid
+import zlib
+import errno
+import shutil
+import bisect
+import hashlib
+import unicodedata
+import datetime
+import threading
+
+from collections import OrderedDict
+
+
+class LRUCache(object):
+    """ Thread safe LRU mapping, bounded by number of entries
+    and/or by the total size of the values.
+
+    :param max_entries: max number of entries, None for no limit
+    :param max_size: max total size of the values, None for no limit
+    :param ttl: seconds an entry stays valid, None for no expiration
+    :param sizeof: function giving the size of a value, `len` by default
+    """
+
+    def __init__(self, max_entries=None, max_size=None, ttl=None, sizeof=len):
+        self.max_entries = max_entries
+        self.max_size = max_size
+        self.ttl = ttl
+        self.sizeof = sizeof
+
+        self.size = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+        self._data = OrderedDict() # key : (value, size, expires)
+        self._lock = threading.RLock()
+
+    def __len__(self):
+        return len(self._data)
+
+    def __contains__(self, key):
+        return self.get(key, None, count=False) is not None
+
+    def keys(self):
+        with self._lock:
+            return list(self._data.keys())
+
+    def get(self, key, default=None, count=True):
+        with self._lock:
+            entry = self._data.pop(key, None)
+            if entry is not None and entry[2] is not None and entry[2] < time.time():
+                self.size -= entry[1]
+                entry = None
+            if entry is None:
+                if count: self.misses += 1
+                return default
+            # most recently used last
+            self._data[key] = entry
+            if count: self.hits += 1
+            return entry[0]
+
+    def set(self, key, value, size=None):
+        """ stores `value`, returns False if it can not fit in the cache """
+        size = self.sizeof(value) if size is None else size
+        if self.max_size is not None and size > self.max_size:
+            self.pop(key)
+            return False
+
+        expires = time.time() + self.ttl if self.ttl is not None else None
+        with self._lock:
+            self.pop(key)
+            self._data[key] = (value, size, expires)
+            self.size += size
+            while len(self._data) > 1 and self._full():
+                old, entry = self._data.popitem(last=False)
+                self.size -= entry[1]
+                self.evictions += 1
+        return True
+
+    def pop(self, key, default=None):
+        with self._lock:
+            entry = self._data.pop(key, None)
+            if entry is None:
+                return default
+            self.size -= entry[1]
+            return entry[0]
+
+    def discard(self, predicate):
+        """ removes the entries whose key matches `predicate(key)` """
+        with self._lock:
+            for key in [ k for k in self._data if predicate(k) ]:
+                self.pop(key)
+
+    def clear(self):
+        with self._lock:
+            self._data.clear()
+            self.size = 0
+
+    def stats(self):
+        return { 'entries': len(self._data),
+                 'size': self.size,
+                 'hits': self.hits,
+                 'misses': self.misses,
+                 'evictions': self.evictions,
+               }
+
+    def _full(self):
+        return (self.max_entries is not None and len(self._data) > self.max_entries) \
+            or (self.max_size is not None and self.size > self.max_size)
+
+
+class GraphRevisions(object):
+    """ Revision counter of the graphs edited by this process.
+
+    `bump` is called by the edition api, listeners registered with `listen`
+    are called with the gid on every bump.
+    Revisions are tagged with a token unique to this process, so that an
+    etag can't be mistaken for one issued by another process.
+
+    Editions made by other processes are not seen, with a `ttl` revisions
+    also change every `ttl` seconds so that what is keyed or validated by
+    them is refreshed at least that often.
+
+    :param ttl: max seconds a revision stays valid, None for ever
+    """
+
+    def __init__(self, ttl=None):
+        self.ttl = ttl
+        self.started = self._now()
+
+        self._pid = None
+        self._token = None
+        self._revisions = {} # gid : (revision, last_modified)
+        self._listeners = []
+        self._lock = threading.Lock()
+
+    @property
+    def token(self):
+        # forked processes get their own token
+        if self._pid != os.getpid():
+            self._pid = os.getpid()
+            self._token = uuid.uuid4().hex[:8]
+        return self._token
+
+    @staticmethod
+    def _now():
+        # http dates have a one second precision
+        return datetime.datetime.utcnow().replace(microsecond=0)
+
+    def _epoch(self, gid):
+        """ :returns: (number, start time) of the current ttl window of the graph """
+        if not self.ttl:
+            return 0, 0
+        # windows of the graphs are shifted so they do not all expire at once
+        shift = zlib.crc32(gid.encode('utf8')) % int(self.ttl)
+        epoch = int((time.time() + shift) // self.ttl)
+        return epoch, epoch * self.ttl - shift
+
+    def get(self, gid):
+        """ :returns: (revision, last modification datetime) of the graph """
+        return self._revisions.get(gid, (0, self.started))
+
+    def revision(self, gid):
+        revision = "%s-%s" % (self.token, self.get(gid)[0])
+        if self.ttl:
+            revision += "-%s" % self._epoch(gid)[0]
+        return revision
+
+    def last_modified(self, gid):
+        modified = self.get(gid)[1]
+        if self.ttl:
+            start = datetime.datetime.utcfromtimestamp(int(self._epoch(gid)[1]))
+            modified = max(modified, start)
+        return modified
+
+    def etag(self, gid, *parts):
+        """ strong etag for a representation of the graph """
+        key = "/".join( [gid, self.revision(gid)] + [ str(p) for p in parts ] )
+        return hashlib.sha1(key.encode('utf8')).hexdigest()
+
+    def bump(self, gid):
+        with self._lock:
+            revision = self._revisions.get(gid, (0,))[0] + 1
+            self._revisions[gid] = (revision, self._now())
+        for listener in self._listeners:
+            listener(gid)
+
+    def listen(self, listener):
+        self._listeners.append(listener)
+
+
+class DumpCache(object):
+    """ Serialized graph dumps keyed by (gid, format, revision),
+    held in a size bounded LRU with an optional on disk tier.
+
+    Entries of a graph are dropped as soon as its revision is bumped, and
+    are not used anymore once its revision expires, see `GraphRevisions`.
+
+    The disk tier keeps the last dump of every (graph, format) in a
+    directory of the process, directories of dead processes are removed.
+
+    :param revisions: `GraphRevisions` giving graph revisions
+    :param max_size: max bytes held in memory
+    :param path: directory of the disk tier, None to disable
+    :param max_disk_size: max bytes of a dump written on disk
+    :param buffer_size: max bytes of a streamed dump held in memory,
+        larger ones are written to the disk tier as they stream
+    """
+
+    def __init__(self, revisions, max_size=256*1024*1024, path=None, max_disk_size=1024*1024*1024,
+                       buffer_size=8*1024*1024):
+        self.revisions = revisions
+        self.memory = LRUCache(max_size=max_size, ttl=revisions.ttl)
+        self.path = path
+        self.max_disk_size = max_disk_size
+        self.buffer_size = buffer_size
+
+        self._pid = None
+        self._disk = {} # (gid, fmt) : revision of the dump on disk
+        self._lock = threading.Lock()
+
+        if path is not None and not os.path.isdir(path):
+            os.makedirs(path)
+
+        revisions.listen(self.invalidate)
+
+    def stream(self, gid, fmt, chunks, revision=None):
+        """ yields `chunks` and caches the dump they make once all are sent.
+        At most `buffer_size` bytes are kept in memory, beyond the chunks
+        go to the disk tier, or the dump is not cached without one.
+        """
+        revision = revision or self.revisions.revision(gid)
+        kept, size, spool = [], 0, None
+        try:
+            for chunk in chunks:
+                size += len(chunk)
+                if kept is not None and size > self.buffer_size:
+                    if self.path is not None and size <= self.max_disk_size:
+                        spool = self._open(gid, fmt)
+                        spool.write("".join(kept))
+                    kept = None
+                if kept is not None:
+                    kept.append(chunk)
+                elif spool is not None:
+                    if size > self.max_disk_size:
+                        self._discard(spool)
+                        spool = None
+                    else :
+                        spool.write(chunk)
+                yield chunk
+
+            if kept is not None:
+                self.set(gid, fmt, "".join(kept), revision)
+            elif spool is not None:
+                self._commit(spool, (gid, fmt, revision))
+                spool = None
+        finally:
+            if spool is not None:
+                self._discard(spool)
+
+    def get(self, gid, fmt, revision=None):
+        key = (gid, fmt, revision or self.revisions.revision(gid))
+        data = self.memory.get(key)
+        if data is None and self.path is not None and self._on_disk(gid, fmt) == key[2]:
+            try:
+                with open(self._filename(gid, fmt), 'rb') as f:
+                    data = f.read()
+            except IOError:
+                return None
+            self.memory.set(key, data)
+        return data
+
+    def set(self, gid, fmt, data, revision=None):
+        """ stores a dump of the graph at `revision`, the current one by default.
+        Dumps of an outdated revision are ignored.
+        """
+        if revision is not None and revision != self.revisions.revision(gid):
+            return
+        key = (gid, fmt, revision or self.revisions.revision(gid))
+        if not self.memory.set(key, data) or self.path is not None:
+            self._write(key, data)
+
+    def invalidate(self, gid):
+        self.memory.discard(lambda key: key[0] == gid)
+        if self.path is not None:
+            with self._lock:
+                formats = [ fmt for g, fmt in self._disk if g == gid ]
+                for fmt in formats:
+                    self._disk.pop((gid, fmt), None)
+            for fmt in formats:
+                try:
+                    os.remove(self._filename(gid, fmt))
+                except OSError:
+                    pass
+
+    def stats(self):
+        return self.memory.stats()
+
+    def _on_disk(self, gid, fmt):
+        self._directory()
+        return self._disk.get((gid, fmt))
+
+    def _directory(self):
+        """ disk tier directory of this process, created on first use """
+        pid = os.getpid()
+        directory = os.path.join(self.path, "%s-%s" % (pid, self.revisions.token))
+        if self._pid != pid:
+            with self._lock:
+                if self._pid != pid:
+                    # a forked process starts with an empty tier
+                    self._disk = {}
+                    self._purge()
+                    if not os.path.isdir(directory):
+                        os.makedirs(directory)
+                    self._pid = pid
+        return directory
+
+    def _purge(self):
+        """ removes the directories of the processes that are gone """
+        for name in os.listdir(self.path):
+            try:
+                pid = int(name.split("-")[0])
+                os.kill(pid, 0)
+            except ValueError:
+                continue
+            except OSError as err:
+                if err.errno == errno.ESRCH:
+                    shutil.rmtree(os.path.join(self.path, name), ignore_errors=True)
+
+    def _filename(self, gid, fmt):
+        name = "%s.%s" % (hashlib.sha1(gid.encode('utf8')).hexdigest()[:16], fmt)
+        return os.path.join(self._directory(), name)
+
+    def _write(self, key, data):
+        if self.path is None or len(data) > self.max_disk_size:
+            return
+        gid, fmt, revision = key
+        spool = self._open(gid, fmt)
+        try:
+            spool.write(data)
+        except IOError:
+            self._discard(spool)
+            return
+        self._commit(spool, key)
+
+    def _open(self, gid, fmt):
+        """ temporary file of a dump written to the disk tier """
+        tmp = "%s.%s.tmp" % (self._filename(gid, fmt), threading.current_thread().ident)
+        return open(tmp, 'wb')
+
+    @staticmethod
+    def _discard(spool):
+        spool.close()
+        try:
+            os.remove(spool.name)
+        except OSError:
+            pass
+
+    def _commit(self, spool, key):
+        gid, fmt, revision = key
+        spool.close()
+        if revision != self.revisions.revision(gid):
+            # outdated while it was written
+            return self._discard(spool)
+        try:
+            with self._lock:
+                # replaces the dump of a previous revision
+                os.rename(spool.name, self._filename(gid, fmt))
+                self._disk[(gid, fmt)] = revision
+        except OSError:
+            self._discard(spool)
+
+
+def fold(text):
+    """ lower case, accents free version of `text` """
+    if isinstance(text, str):
+        text = text.decode('utf8')
+    text = unicodedata.normalize('NFKD', text)
+    return u"".join( c for c in text if not unicodedata.combining(c) ).lower()
+
+def entry_label(entry):
+    """ label of a completion entry """
+    label = entry.get('label')
+    if label is None:
+        label = entry.get('properties', {}).get('label', u"")
+    return label
+
+
+class CompletionIndex(object):
+    """ Sorted label index of the completion entries of a graph.
+
+    :param entries: completion entries, dicts with an `uuid`
+    :param folding: function applied to labels and prefixes, e.g. `fold`
+    """
+
+    def __init__(self, entries, folding=None):
+        self.folding = folding or (lambda label: label)
+        self.entries = {}   # uuid : entry
+        self.keys = []      # sorted (folded label, uuid)
+        for entry in entries:
+            self.entries[entry['uuid']] = entry
+        self.keys = sorted( (self.folding(entry_label(e)), uuid) for uuid, e in self.entries.iteritems() )
+
+    def __len__(self):
+        return len(self.keys)
+
+    def complete(self, prefix, start=0, size=100):
+        """ entries whose label starts with `prefix`, in label order """
+        prefix = self.folding(prefix or u"")
+        i = bisect.bisect_left(self.keys, (prefix,)) + start
+        found = []
+        while i < len(self.keys) and len(found) < size and self.keys[i][0].startswith(prefix):
+            found.append(self.entries[self.keys[i][1]])
+            i += 1
+        return found
+
+    def upsert(self, entry):
+        self.remove(entry['uuid'])
+        self.entries[entry['uuid']] = entry
+        bisect.insort(self.keys, (self.folding(entry_label(entry)), entry['uuid']))
+
+    def remove(self, uuid):
+        entry = self.entries.get(uuid)
+        if entry is not None:
+            # the key first, keys always have an entry
+            key = (self.folding(entry_label(entry)), uuid)
+            i = bisect.bisect_left(self.keys, key)
+            if i < len(self.keys) and self.keys[i] == key:
+                del self.keys[i]
+            del self.entries[uuid]
+
+
+class CompletionIndexes(object):
+    """ `CompletionIndex` per (graph, object type), built on first use.
+
+    Graphs with more entries than `max_entries` are not indexed, they are
+    completed by `fallback`, and remembered as such for `oversized_ttl`
+    seconds.
+
+    :param loader: function (gid, obj_type, limit) giving the completion
+        entries, it may stop past `limit` entries
+    :param fallback: function (gid, obj_type, prefix, start, size) completing
+        the graphs too large to be indexed
+    :param max_entries: max number of entries held by all the indexes,
+        the least recently used indexes are dropped beyond
+    :param folding: see `CompletionIndex`
+    :param oversized_ttl: seconds before indexing a too large graph is tried again
+    """
+
+    def __init__(self, loader, fallback, max_entries=1000000, folding=fold, oversized_ttl=600):
+        self.loader = loader
+        self.fallback = fallback
+        self.folding = folding
+        self.indexes = LRUCache(max_size=max_entries, sizeof=len)
+        self.oversized = LRUCache(max_entries=10000, ttl=oversized_ttl)
+        self._lock = threading.Lock()
+
+    def complete(self, gid, obj_type, prefix, start=0, size=100):
+        index = self.get(gid, obj_type)
+        if index is None:
+            return self.fallback(gid, obj_type, prefix, start, size)
+        with self._lock:
+            return index.complete(prefix, start, size)
+
+    def get(self, gid, obj_type):
+        """ the index of the graph, None if it is too large """
+        key = (gid, obj_type)
+        index = self.indexes.get(key)
+        if index is None and key not in self.oversized:
+            entries = self.loader(gid, obj_type, self.indexes.max_size)
+            if len(entries) <= self.indexes.max_size:
+                index = CompletionIndex(entries, self.folding)
+                self.indexes.set(key, index)
+            else :
+                self.oversized.set(key, True, size=1)
+        return index
+
+    def built(self, gid):
+        """ object types of the indexes of `gid` currently held """
+        return [ obj_type for g, obj_type in self.indexes.keys() if g == gid ]
+
+    def refresh(self, gid, uuid, fetch):
+        """ updates `uuid` in the indexes of the graph
+        :param fetch: function (obj_type) giving the fresh entries that may
+            contain `uuid`, it is removed if they do not
+        """
+        for obj_type in self.built(gid):
+            index = self.indexes.get((gid, obj_type), count=False)
+            if index is None: continue
+            fresh = [ e for e in fetch(obj_type) if e.get('uuid') == uuid ]
+            with self._lock:
+                if len(fresh):
+                    index.upsert(fresh[0])
+                else :
+                    index.remove(uuid)
+            self._resize(gid, obj_type, index)
+
+    def remove(self, gid, uuid):
+        for obj_type in self.built(gid):
+            index = self.indexes.get((gid, obj_type), count=False)
+            if index is None: continue
+            with self._lock:
+                index.remove(uuid)
+            self._resize(gid, obj_type, index)
+
+    def invalidate(self, gid):
+        self.indexes.discard(lambda key: key[0] == gid)
+        self.oversized.discard(lambda key: key[0] == gid)
+
+    def stats(self):
+        stats = self.indexes.stats()
+        stats['oversized'] = len(self.oversized)
+        return stats
+
+    def _resize(self, gid, obj_type, index):
+        # the size of an index is accounted when it is set
+        if self.indexes.get((gid, obj_type), count=False) is index:
+            self.indexes.set((gid, obj_type), index)
+
+
+class DegreeIndex(object):
+    """ Neighbor counts of the nodes, per graph and mode (IN, OUT, ALL).
+
+    Counts are read through on first use, edge editions drop the counts of
+    their ends, node deletions the counts of the whole graph.
+
+    :param counter: function (gid, uuid, mode) giving a neighbor count
+    :param max_entries: max number of counts held
+    :param ttl: seconds a count stays valid, bounds the staleness of counts
+        edited by other processes
+    """
+
+    MODES = ("IN", "OUT", "ALL")
+
+    def __init__(self, counter, max_entries=1000000, ttl=None):
+        self.counter = counter
+        self.counts = LRUCache(max_entries=max_entries, ttl=ttl)
+
+    def get(self, gid, uuid, mode="ALL"):
+        mode = mode.upper()
+        if mode not in self.MODES:
+            raise ValueError("unknown neighbors mode %s" % mode)
+        count = self.counts.get((gid, uuid, mode))
+        if count is None:
+            count = self.counter(gid, uuid, mode)
+            self.counts.set((gid, uuid, mode), count, size=1)
+        return count
+
+    def degrees(self, gid, uuid):
+        """ :returns: { mode: count } """
+        return dict( (mode, self.get(gid, uuid, mode)) for mode in self.MODES )
+
+    def edges_changed(self, gid, edges):
+        """ drops the counts of the ends of `edges`, dicts with `source` and `target`,
+        or the counts of the whole graph when an end is unknown
+        """
+        edges = list(edges)
+        if not all( edge.get('source') and edge.get('target') for edge in edges ):
+            return self.invalidate(gid)
+        for edge in edges:
+            for end in ('source', 'target'):
+                for mode in self.MODES:
+                    self.counts.pop((gid, edge.get(end), mode))
+
+    def invalidate(self, gid):
+        self.counts.discard(lambda key: key[0] == gid)
+
+    def stats(self):
+        return self.counts.stats()
+
+
+class StarredSet(object):
+    """ Bitmap of the starred nodes of a graph, over interned node ids """
+
+    def __init__(self, uuids=()):
+        self.ids = {}       # uuid : id
+        self.uuids = []     # id : uuid
+        self.bits = bytearray()
+        self.count = 0
+        self.update(uuids, True)
+
+    def __len__(self):
+        return self.count
+
+    def intern(self, uuid):
+        i = self.ids.get(uuid)
+        if i is None:
+            i = self.ids[uuid] = len(self.uuids)
+            self.uuids.append(uuid)
+            if len(self.bits) * 8 <= i:
+                self.bits.extend(b"\0" * max(len(self.bits), 64))
+        return i
+
+    def contains(self, uuid):
+        i = self.ids.get(uuid)
+        return i is not None and bool(self.bits[i >> 3] & (1 << (i & 7)))
+
+    def update(self, uuids, starred):
+        for uuid in uuids:
+            i = self.intern(uuid)
+            byte, mask = i >> 3, 1 << (i & 7)
+            if bool(self.bits[byte] & mask) != starred:
+                self.bits[byte] ^= mask
+                self.count += 1 if starred else -1
+
+    def starred(self):
+        """ uuids of the starred nodes, in interning order """
+        found = []
+        for byte, value in enumerate(self.bits):
+            if not value: continue
+            for bit in xrange(8):
+                if value & (1 << bit):
+                    found.append(self.uuids[(byte << 3) + bit])
+        return found
+
+
+class StarredSets(object):
+    """ `StarredSet` per graph, loaded on first use and kept up to date
+    by the star and unstar editions of this process.
+
+    Editions made while a set is loading are replayed on it once loaded.
+    Sets are loaded again after `ttl` seconds, to see the editions of other
+    processes.
+
+    :param max_nodes: max number of interned nodes held by all the sets,
+        the least recently used sets are dropped beyond
+    :param ttl: seconds a set stays valid, None for ever
+    """
+
+    def __init__(self, max_nodes=10000000, ttl=60):
+        self.sets = LRUCache(max_size=max_nodes, ttl=ttl, sizeof=lambda s: len(s.uuids))
+        self._loading = {}  # gid : [ editions made during a load ]
+        self._lock = threading.Lock()
+
+    def get(self, gid, loader):
+        """ :param loader: function (gid) giving the uuids of the starred nodes """
+        with self._lock:
+            stars = self.sets.get(gid)
+            if stars is not None:
+                return stars
+            editions = []
+            self._loading.setdefault(gid, []).append(editions)
+
+        stars = StarredSet(loader(gid))
+
+        with self._lock:
+            loading = self._loading.get(gid, [])
+            if not any( e is editions for e in loading ):
+                # invalidated during the load
+                return stars
+            loading.remove(editions)
+            if not len(loading):
+                del self._loading[gid]
+            for uuids, starred in editions:
+                stars.update(uuids, starred)
+            current = self.sets.get(gid, count=False)
+            if current is not None:
+                return current
+            self.sets.set(gid, stars)
+        return stars
+
+    def loaded(self, gid):
+        """ the set of `gid` if it is loaded, None otherwise """
+        return self.sets.get(gid, count=False)
+
+    def starred(self, gid, loader):
+        stars = self.get(gid, loader)
+        with self._lock:
+            return stars.starred()
+
+    def contains(self, gid, uuid, loader):
+        stars = self.get(gid, loader)
+        with self._lock:
+            return stars.contains(uuid)
+
+    def update(self, gid, uuids, starred):
+        """ stars or unstars nodes of a graph, if its set is loaded or loading """
+        uuids = list(uuids)
+        with self._lock:
+            for editions in self._loading.get(gid, []):
+                editions.append((uuids, starred))
+            stars = self.sets.get(gid, count=False)
+            if stars is not None:
+                size = len(stars.uuids)
+                stars.update(uuids, starred)
+                if len(stars.uuids) != size:
+                    # the size of a set is accounted when it is set
+                    self.sets.set(gid, stars)
+
+    def invalidate(self, gid):
+        with self._lock:
+            self.sets.pop(gid)
+            self._loading.pop(gid, None)
+
+    def stats(self):
+        return self.sets.stats()
+
+
+# shared by the edition and exploration apis of this process,
+# editions of other processes are seen within a minute
+revisions = GraphRevisions(ttl=60)
+dumps = DumpCache(revisions)
+starred = StarredSets()
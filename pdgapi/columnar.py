@@ -0,0 +1,197 @@
+#-*- coding:utf-8 -*-
+""" Columnar binary export of igraph graphs.
+
+A file is made of:
+    * the magic string `PDGCOL01`,
+    * the header length as a little endian uint64,
+    * a utf8 json header,
+    * 8 bytes aligned column blocks.
+
+The header gives the graph attributes, vertex and edge counts and, for
+every block, its `name`, numpy `dtype`, `shape`, `offset` from the start of
+the file and `nbytes`.
+
+Blocks:
+    * `edges`: int32 (ecount, 2) source and target vertex indexes
+    * `weights`: float64 (ecount,) edge `weight` attribute, 1. if missing
+    * `uuids`: string table of the vertex uuids
+    * `vs.<attr>`, `es.<attr>`: one column per vertex and edge attribute
+
+Attributes holding only booleans, integers or floats are stored as `bool`,
+`int64` or `float64` arrays. Other attributes are string tables: `<name>` is
+the int64 (count+1,) offsets array of the strings in the uint8 `<name>.data`
+block. Their header `kind` is `str` for utf8 strings, `json` when values
+were json encoded.
+
+The file can be `mmap`ed and its blocks used as numpy arrays without copy,
+see `load`.
+"""
+
+import json
+import struct
+
+import numpy as np
+
+
+MAGIC = b"PDGCOL01"
+ALIGN = 8
+
+
+def _pad(size):
+    return (ALIGN - size % ALIGN) % ALIGN
+
+def _column(values):
+    """ :returns: (kind, array or list of utf8 strings) """
+    if all( isinstance(v, bool) for v in values ):
+        return "bool", np.asarray(values, dtype='|b1')
+    if all( isinstance(v, (int, long)) and not isinstance(v, bool) for v in values ):
+        try:
+            return "int", np.asarray(values, dtype='<i8')
+        except OverflowError:
+            pass
+    if all( isinstance(v, (int, long, float)) and not isinstance(v, bool) for v in values ):
+        return "float", np.asarray(values, dtype='<f8')
+    if all( v is None or isinstance(v, basestring) for v in values ):
+        return "str", [ v if isinstance(v, bytes) else (v or u"").encode('utf8') for v in values ]
+    return "json", [ json.dumps(v) for v in values ]
+
+def _strings(strings):
+    """ :returns: (offsets, data) arrays of a string table """
+    offsets = np.zeros(len(strings) + 1, dtype='<i8')
+    np.cumsum([ len(s) for s in strings ], out=offsets[1:])
+    blob = b"".join(strings)
+    data = np.frombuffer(blob, dtype='|u1') if len(blob) else np.zeros(0, dtype='|u1')
+    return offsets, data
+
+
+def dumps(graph, id_attribute='uuid', weight_attribute='weight'):
+    """ columnar binary export of an igraph graph
+    :returns: str
+    """
+    blocks = [] # (name, kind, array)
+
+    edges = np.asarray(graph.get_edgelist(), dtype='<i4').reshape((graph.ecount(), 2))
+    blocks.append(("edges", "int", edges))
+
+    if weight_attribute in graph.es.attributes():
+        weights = np.asarray(graph.es[weight_attribute], dtype='<f8')
+    else :
+        weights = np.ones(graph.ecount(), dtype='<f8')
+    blocks.append(("weights", "float", weights))
+
+    if id_attribute in graph.vs.attributes():
+        ids = [ v.encode('utf8') if isinstance(v, unicode) else bytes(v) for v in graph.vs[id_attribute] ]
+    else :
+        ids = [ bytes(i) for i in xrange(graph.vcount()) ]
+    offsets, data = _strings(ids)
+    blocks += [ ("uuids", "str", offsets), ("uuids.data", "data", data) ]
+
+    for prefix, seq, skip in (("vs", graph.vs, id_attribute), ("es", graph.es, weight_attribute)):
+        for attr in seq.attributes():
+            if attr == skip: continue
+            name = "%s.%s" % (prefix, attr)
+            kind, column = _column(seq[attr])
+            if kind in ("str", "json"):
+                offsets, data = _strings(column)
+                blocks += [ (name, kind, offsets), (name + ".data", "data", data) ]
+            else :
+                blocks.append((name, kind, column))
+
+    attributes = {}
+    for attr in graph.attributes():
+        try:
+            attributes[attr] = json.loads(json.dumps(graph[attr]))
+        except (TypeError, ValueError):
+            attributes[attr] = repr(graph[attr])
+
+    layout = [ { "name": name,
+                 "kind": kind,
+                 "dtype": array.dtype.str,
+                 "shape": list(array.shape),
+                 "offset": 0,
+                 "nbytes": array.nbytes } for name, kind, array in blocks ]
+
+    header = { "version": 1,
+               "directed": graph.is_directed(),
+               "vcount": graph.vcount(),
+               "ecount": graph.ecount(),
+               "attributes": attributes,
+               "blocks": layout }
+
+    # offsets follow the header, whose length depends on the offsets :
+    # iterate until stable
+    start = 0
+    while True:
+        for block, rel in zip(layout, _relative(layout)):
+            block["offset"] = start + rel
+        encoded = json.dumps(header).encode('utf8')
+        size = len(MAGIC) + 8 + len(encoded)
+        if size + _pad(size) == start:
+            break
+        start = size + _pad(size)
+
+    chunks = [ MAGIC, struct.pack('<Q', len(encoded)), encoded, b"\0" * _pad(size) ]
+    for name, kind, array in blocks:
+        chunks.append(array.tobytes())
+        chunks.append(b"\0" * _pad(array.nbytes))
+    return b"".join(chunks)
+
+def _relative(layout):
+    position = 0
+    for block in layout:
+        yield position
+        position += block["nbytes"] + _pad(block["nbytes"])
+
+
+class StringColumn(object):
+    """ lazy view over a string table """
+
+    def __init__(self, offsets, data, kind="str"):
+        self.offsets = offsets
+        self.data = data
+        self.kind = kind
+
+    def __len__(self):
+        return len(self.offsets) - 1
+
+    def __getitem__(self, i):
+        value = self.data[self.offsets[i]:self.offsets[i+1]].tobytes().decode('utf8')
+        return json.loads(value) if self.kind == "json" else value
+
+    def __iter__(self):
+        for i in xrange(len(self)):
+            yield self[i]
+
+
+def load(source):
+    """ reads a columnar export without copying its blocks
+    :param source: file path, memory mapped, or buffer
+    :returns: (header, columns) where columns maps block names to numpy
+        arrays, or to `StringColumn` for string tables
+    """
+    if isinstance(source, basestring) and not source.startswith(MAGIC):
+        buf = np.memmap(source, dtype='|u1', mode='r')
+    else :
+        buf = np.frombuffer(source, dtype='|u1')
+
+    if buf[:len(MAGIC)].tobytes() != MAGIC:
+        raise ValueError("not a columnar graph export")
+    length, = struct.unpack('<Q', buf[len(MAGIC):len(MAGIC)+8].tobytes())
+    start = len(MAGIC) + 8
+    header = json.loads(buf[start:start+length].tobytes().decode('utf8'))
+
+    arrays = {}
+    for block in header["blocks"]:
+        raw = buf[block["offset"]:block["offset"] + block["nbytes"]]
+        arrays[block["name"]] = raw.view(np.dtype(str(block["dtype"]))).reshape(block["shape"])
+
+    columns = {}
+    for block in header["blocks"]:
+        name, kind = block["name"], block["kind"]
+        if kind == "data":
+            continue
+        if kind in ("str", "json"):
+            columns[name] = StringColumn(arrays[name], arrays[name + ".data"], kind)
+        else :
+            columns[name] = arrays[name]
+    return header, columns
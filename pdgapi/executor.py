@@ -0,0 +1,223 @@
+#-*- coding:utf-8 -*-
+""" Bounded execution of CPU bound calls in worker processes """
+
+import os
+import time
+import traceback
+import threading
+import multiprocessing
+
+
+class ExecutorBusy(Exception):
+    """ too many calls are already waiting for a worker """
+
+class ExecutorTimeout(Exception):
+    """ the call did not complete in time and was killed """
+
+class ExecutorError(Exception):
+    """ the call failed in the worker process """
+    def __init__(self, message, trace=""):
+        super(ExecutorError, self).__init__(message)
+        self.trace = trace
+
+
+# functions known to the workers, registered before they are forked
+_functions = {}
+
+def _call(name, fct, args, kwargs):
+    try:
+        fct = _functions[name] if name is not None else fct
+        return (True, fct(*args, **kwargs))
+    except Exception as err:
+        return (False, (repr(err), traceback.format_exc()))
+
+
+def _serve(conn):
+    """ loop of a worker process, runs the calls received on `conn` """
+    while True:
+        try:
+            task = conn.recv()
+        except EOFError:
+            return
+        result = _call(*task)
+        try:
+            conn.send(result)
+        except Exception as err:
+            # unpicklable result
+            conn.send((False, (repr(err), traceback.format_exc())))
+
+
+class Worker(object):
+    """ worker process and its end of the pipe """
+
+    def __init__(self, generation):
+        self.generation = generation
+        self.tasks = 0
+        self.stopped = False
+        self.conn, child = multiprocessing.Pipe()
+        self.process = multiprocessing.Process(target=_serve, args=(child,))
+        self.process.daemon = True
+        self.process.start()
+        child.close()
+
+    def stop(self):
+        if self.stopped: return
+        self.stopped = True
+        self.conn.close()
+        if self.process.is_alive():
+            self.process.terminate()
+        self.process.join()
+
+
+class ProcessExecutor(object):
+    """ Runs calls in at most `workers` persistent processes.
+
+    Workers are forked on demand and reused from call to call. A call that
+    times out only kills the worker running it, which is replaced by the
+    next call.
+
+    Calls and their arguments are pickled to the workers. Functions that
+    can not be pickled, bound methods or components, are registered by
+    name with `register` and run by name, the workers are forked after the
+    registration and share them with the caller.
+    Calls should not use connections opened by the caller.
+
+    :param workers: max number of worker processes
+    :param max_queue: max number of calls waiting for a worker,
+        further calls raise `ExecutorBusy`
+    :param timeout: seconds a call may wait and run before `ExecutorTimeout`,
+        its worker is then killed
+    :param max_tasks: calls run by a worker before it is replaced, None to keep it
+    """
+
+    def __init__(self, workers=None, max_queue=16, timeout=60., max_tasks=1000):
+        self.workers = workers or multiprocessing.cpu_count()
+        self.max_queue = max_queue
+        self.timeout = timeout
+        self.max_tasks = max_tasks
+
+        self.running = 0
+        self.waiting = 0
+        self._idle = []         # workers waiting for a call
+        self._generation = 0    # workers of older generations miss registrations
+        self._pid = os.getpid()
+        self._cond = threading.Condition()
+        self._counters = { 'calls': 0, 'rejected': 0, 'timeouts': 0, 'errors': 0,
+                           'wait_time': 0., 'compute_time': 0. }
+
+    def register(self, name, fct):
+        """ makes `fct` callable in the workers as `name` """
+        with self._cond:
+            _functions[name] = fct
+            # workers forked before do not know it
+            self._generation += 1
+            self._terminate()
+
+    def stats(self):
+        """ call counters, cumulated and mean wait and compute times """
+        with self._cond:
+            stats = dict(self._counters)
+            stats['running'] = self.running
+            stats['waiting'] = self.waiting
+            stats['idle'] = len(self._idle)
+        done = max(stats['calls'] - stats['rejected'], 1)
+        stats['mean_wait_time'] = stats['wait_time'] / done
+        stats['mean_compute_time'] = stats['compute_time'] / done
+        return stats
+
+    def run(self, fct, *args, **kwargs):
+        """ :returns: fct(*args, **kwargs), computed in a worker process,
+        `fct` is a function or the name of a registered one """
+        start = time.time()
+        deadline = start + self.timeout
+
+        with self._cond:
+            self._counters['calls'] += 1
+            if self.running >= self.workers and self.waiting >= self.max_queue:
+                self._counters['rejected'] += 1
+                raise ExecutorBusy("%s calls running, %s waiting" % (self.running, self.waiting))
+
+            self.waiting += 1
+            try:
+                while self.running >= self.workers:
+                    remaining = deadline - time.time()
+                    if remaining <= 0:
+                        self._counters['timeouts'] += 1
+                        self._counters['wait_time'] += time.time() - start
+                        raise ExecutorTimeout("no worker available after %ss" % self.timeout)
+                    self._cond.wait(remaining)
+            finally:
+                self.waiting -= 1
+            self.running += 1
+            worker = self._checkout()
+
+        started = time.time()
+        try:
+            if worker is None:
+                worker = Worker(self._generation)
+            return self._apply(worker, fct, args, kwargs, deadline - started)
+        finally:
+            with self._cond:
+                self.running -= 1
+                self._checkin(worker)
+                self._counters['wait_time'] += started - start
+                self._counters['compute_time'] += time.time() - started
+                self._cond.notify()
+
+    def _checkout(self):
+        """ an idle worker, None to fork one """
+        if self._pid != os.getpid():
+            # workers inherited from a parent process are not ours
+            self._idle = []
+            self._pid = os.getpid()
+        return self._idle.pop() if len(self._idle) else None
+
+    def _checkin(self, worker):
+        if worker is None:
+            return
+        if not worker.stopped and worker.generation == self._generation \
+           and (self.max_tasks is None or worker.tasks < self.max_tasks):
+            self._idle.append(worker)
+        else :
+            worker.stop()
+
+    def _terminate(self):
+        """ stops the idle workers """
+        idle, self._idle = self._idle, []
+        if self._pid == os.getpid():
+            for worker in idle:
+                worker.stop()
+
+    def _apply(self, worker, fct, args, kwargs, timeout):
+        name = fct if isinstance(fct, basestring) else None
+        worker.tasks += 1
+        try:
+            worker.conn.send((name, None if name else fct, args, kwargs))
+        except Exception as err:
+            # unpicklable call, nothing was sent
+            self._count('errors')
+            raise ExecutorError(repr(err), traceback.format_exc())
+
+        if not worker.conn.poll(max(timeout, 0)):
+            self._count('timeouts')
+            worker.stop()
+            raise ExecutorTimeout("call killed after %ss" % self.timeout)
+        try:
+            ok, result = worker.conn.recv()
+        except (EOFError, IOError):
+            self._count('errors')
+            worker.stop()
+            raise ExecutorError("worker %s died" % worker.process.pid)
+        except Exception as err:
+            # unpicklable result
+            self._count('errors')
+            raise ExecutorError(repr(err), traceback.format_exc())
+
+        if not ok:
+            self._count('errors')
+            raise ExecutorError(*result)
+        return result
+
+    def _count(self, key):
+        with self._cond:
+            self._counters[key] += 1
@@ -2,11 +2,95 @@
 
 from reliure.web import ReliureAPI, EngineView
 from reliure.pipeline import Optionable, Composable
-from reliure.types import GenericType
+from reliure.types import GenericType, Numeric
 from reliure.engine import Engine
 
+from flask import abort
+
+from cello.graphs import export_graph
 from cello.clustering import export_clustering
 
+from pdgapi import cache as cache_module
+from pdgapi import columnar
+from pdgapi.cache import LRUCache
+from pdgapi.executor import ExecutorBusy, ExecutorTimeout
+
+import json
+import zlib
+import random
+import hashlib
+
+
+def iter_graph_json(graph, chunk_size=500, id_attribute=None, exclude_gattrs=(), exclude_vattrs=(), exclude_eattrs=()):
+    """ yields the json export of `graph` (see `export_graph`) piece by piece,
+    graph attributes first then vertices and edges by `chunk_size`.
+    Vertices and edges are encoded straight from `graph.vs` and `graph.es`,
+    the whole export is never held in memory.
+    """
+    encode = json.JSONEncoder().encode
+
+    # attributes of an empty copy, same graph and attribute names
+    head = export_graph(graph.subgraph([]), id_attribute=id_attribute,
+                exclude_gattrs=exclude_gattrs, exclude_vattrs=exclude_vattrs, exclude_eattrs=exclude_eattrs)
+    head.pop('vs', None)
+    head.pop('es', None)
+
+    if id_attribute is not None:
+        ids = graph.vs[id_attribute]
+        vid = lambda index: ids[index]
+    else :
+        vid = lambda index: index
+
+    def vertices():
+        for vtx in graph.vs:
+            vertex = vtx.attributes()
+            if id_attribute is None:
+                vertex['_id'] = vtx.index
+            for attr in exclude_vattrs:
+                vertex.pop(attr, None)
+            yield vertex
+
+    def edges():
+        for edg in graph.es:
+            edge = edg.attributes()
+            for attr in exclude_eattrs:
+                edge.pop(attr, None)
+            edge['s'] = vid(edg.source)
+            edge['t'] = vid(edg.target)
+            yield edge
+
+    sep = ""
+    yield "{"
+    for key in head:
+        yield '%s%s: %s' % (sep, encode(key), encode(head[key]))
+        sep = ", "
+    for key, items in (('vs', vertices()), ('es', edges())):
+        yield '%s%s: [' % (sep, encode(key))
+        for n, chunk in enumerate(chunked(items, chunk_size)):
+            yield (", " if n else "") + ", ".join( encode(e) for e in chunk )
+        yield "]"
+        sep = ", "
+    yield "}"
+
+def chunked(iterable, size):
+    """ yields lists of at most `size` items """
+    chunk = []
+    for item in iterable:
+        chunk.append(item)
+        if len(chunk) >= size:
+            yield chunk
+            chunk = []
+    if len(chunk):
+        yield chunk
+
+def iter_gzip(chunks, level=6):
+    """ gzip compress an iterable of strings on the fly """
+    compressor = zlib.compressobj(level, zlib.DEFLATED, zlib.MAX_WBITS | 16)
+    for chunk in chunks:
+        data = compressor.compress(chunk)
+        if data: yield data
+    yield compressor.flush()
+
 def QueryUnit(**kwargs):
     default = {
         "query" : "jouer"
@@ -79,8 +163,235 @@ class AdditiveNodes(GenericType):
 
 
 
+class CachedEngineView(EngineView):
+    """ EngineView keeping the outputs of its runs in a LRU cache,
+    keyed by a canonical hash of the inputs, options and graph revision.
+    Edge lists are hashed whatever the order of their edges.
+
+    :param cache: `LRUCache` of the outputs, by default one of `max_size` bytes
+    :param revisions: `GraphRevisions` of the graphs
+    """
+
+    def __init__(self, engine, name=None, cache=None, max_size=64*1024*1024, revisions=None):
+        EngineView.__init__(self, engine, name=name)
+        self.cache = cache if cache is not None else LRUCache(max_size=max_size)
+        self.revisions = revisions if revisions is not None else cache_module.revisions
+
+    @staticmethod
+    def canonical(data):
+        if isinstance(data, dict) and isinstance(data.get('edgelist'), list):
+            data = dict(data)
+            data['edgelist'] = sorted( json.dumps(e, sort_keys=True) for e in data['edgelist'] )
+        return data
+
+    def key(self, inputs_data, options):
+        inputs = { k: self.canonical(v) for k, v in inputs_data.iteritems() }
+        graphs = sorted( set( v['graph'] for v in inputs_data.itervalues() if isinstance(v, dict) and 'graph' in v ) )
+        revisions = [ self.revisions.revision(gid) for gid in graphs ]
+        return hashlib.sha1(json.dumps([inputs, options, revisions], sort_keys=True)).hexdigest()
+
+    def run(self, inputs_data, options):
+        key = self.key(inputs_data, options)
+        outputs = self.cache.get(key)
+
+        if outputs is None:
+            outputs = EngineView.run(self, inputs_data, options)
+            meta = outputs['meta']
+            failed = len(meta.get('errors', [])) or any( len(d.get('errors', [])) for d in meta.get('details', []) )
+            if not failed:
+                self.cache.set(key, outputs, size=len(json.dumps(outputs)))
+
+        return outputs
+
+
+class ComponentProxy(Optionable):
+    """ Optionable standing for `component`, with the same name and options.
+    Other attributes are read from `component`.
+    """
+
+    def __init__(self, component):
+        Optionable.__init__(self, name=component.name)
+        self.component = component
+        # the option objects of the component, set through the proxy as well
+        self._options = component.options
+
+    def __getattr__(self, name):
+        # called for the attributes missing on the proxy only
+        if name == "component":
+            raise AttributeError(name)
+        return getattr(self.component, name)
+
+    def __call__(self, *args, **kwargs):
+        return self.component(*args, **kwargs)
+
+
+class Offloaded(ComponentProxy):
+    """ Runs `component` through an executor, see `pdgapi.executor`.
+    Answers 503 when the executor is saturated and 504 on timeout.
+    """
+
+    def __init__(self, component, executor):
+        ComponentProxy.__init__(self, component)
+        self.executor = executor
+        # components are not picklable, the workers run it by name
+        self.task = "%s-%s" % (component.name, id(self))
+        executor.register(self.task, component)
+
+    def __call__(self, *args, **kwargs):
+        try:
+            return self.executor.run(self.task, *args, **kwargs)
+        except ExecutorBusy as err:
+            abort(503, str(err))
+        except ExecutorTimeout as err:
+            abort(504, str(err))
+
+
+class IncrementalClustering(ComponentProxy):
+    """ Re-clusters only the communities touched by a change.
+
+    The previous clustering, { uuid: cluster id }, and the uuids of the
+    vertices whose edges changed are read from the `previous` and `changed`
+    graph attributes. Vertices of the touched clusters are clustered again by
+    `component`, other vertices keep their cluster. New vertices join the
+    cluster they are most linked to when all their neighbors are kept, and
+    are clustered again otherwise.
+    Everything is clustered again when more than `max_ratio` of the
+    vertices are touched, or without previous clustering.
+    """
+
+    def __init__(self, component, max_ratio=.5):
+        ComponentProxy.__init__(self, component)
+        self.max_ratio = max_ratio
+
+    def __call__(self, graph, **kwargs):
+        from igraph import VertexClustering
+
+        attributes = graph.attributes()
+        previous = graph['previous'] if 'previous' in attributes else None
+        if not previous:
+            return self.component(graph, **kwargs)
+        changed = set(graph['changed'] or []) if 'changed' in attributes else set()
+
+        touched = set( previous[uuid] for uuid in changed if uuid in previous )
+        kept = {} # previous cluster id : new cluster id
+        membership = [ None ] * graph.vcount()
+        for vtx in graph.vs:
+            cluster = previous.get(vtx['uuid'])
+            if cluster is not None and cluster not in touched:
+                membership[vtx.index] = kept.setdefault(cluster, len(kept))
+
+        # new vertices only linked to kept clusters join the most linked one
+        for vtx in graph.vs:
+            if membership[vtx.index] is not None or vtx['uuid'] in previous:
+                continue
+            clusters = [ membership[n] for n in graph.neighbors(vtx.index) ]
+            if len(clusters) and None not in clusters:
+                membership[vtx.index] = max(set(clusters), key=clusters.count)
+
+        redo = [ i for i, c in enumerate(membership) if c is None ]
+        if len(redo) > self.max_ratio * graph.vcount():
+            return self.component(graph, **kwargs)
+
+        cluster = len(kept)
+        if len(redo):
+            subgraph = graph.induced_subgraph(redo)
+            for vids in self.component(subgraph, **kwargs):
+                for vid in vids:
+                    membership[redo[vid]] = cluster
+                cluster += 1
+            # vertices left out by the component are singletons
+            for i in redo:
+                if membership[i] is None:
+                    membership[i] = cluster
+                    cluster += 1
+
+        return VertexClustering(graph, membership)
+
+
+class WarmStartLayout(Optionable):
+    """ Force directed layout resumed from previous coordinates.
+
+    The previous coordinates, { uuid: [x, y, ...] }, are read from the
+    `coords` graph attribute. Known vertices start from them, new vertices
+    start at the barycenter of their placed neighbors, then a short
+    Fruchterman-Reingold run adjusts the whole layout, which is rescaled to
+    the bounding box of the previous coordinates.
+    Without previous coordinates the `cold` layout is used.
+    """
+
+    def __init__(self, cold, dim=2, weighted=True, name=None):
+        Optionable.__init__(self, name or cold.name)
+        self.cold = cold
+        self.dim = dim
+        self.weighted = weighted
+        self.add_option("warm_niter", Numeric(default=50, min=1, max=500,
+            help="Iterations when resuming from previous coordinates"))
+
+    def seed(self, graph, coords):
+        """ :returns: start positions of the vertices, None if no vertex is known """
+        dim = self.dim
+        positions = [ None ] * graph.vcount()
+        for vtx in graph.vs:
+            coord = coords.get(vtx['uuid'])
+            if coord is not None and len(coord) >= dim:
+                positions[vtx.index] = [ float(c) for c in coord[:dim] ]
+
+        placed = [ p for p in positions if p is not None ]
+        if not len(placed):
+            return None
+
+        low = [ min( p[d] for p in placed ) for d in xrange(dim) ]
+        high = [ max( p[d] for p in placed ) for d in xrange(dim) ]
+        jitter = [ max(h - l, 1.) * .02 for l, h in zip(low, high) ]
+
+        # new vertices join their placed neighbors, a few rounds for chains
+        for _ in xrange(3):
+            todo = [ i for i, p in enumerate(positions) if p is None ]
+            if not len(todo): break
+            for i in todo:
+                around = [ positions[j] for j in graph.neighbors(i) if positions[j] is not None ]
+                if len(around):
+                    positions[i] = [ sum( p[d] for p in around ) / len(around) + random.uniform(-jitter[d], jitter[d])
+                                     for d in xrange(dim) ]
+
+        # unreachable from the placed vertices : anywhere in the box
+        for i, p in enumerate(positions):
+            if p is None:
+                positions[i] = [ random.uniform(low[d] - jitter[d], high[d] + jitter[d]) for d in xrange(dim) ]
+        return positions, low, high
+
+    @Optionable.check
+    def __call__(self, graph, warm_niter=50):
+        coords = graph['coords'] if 'coords' in graph.attributes() else None
+        seed = self.seed(graph, coords) if coords else None
+        if seed is None:
+            return self.cold(graph)
+
+        positions, low, high = seed
+        weights = None
+        if self.weighted and 'weight' in graph.es.attributes():
+            weights = 'weight'
+
+        # low temperature : vertices should not move far from their seed
+        start_temp = max( h - l for l, h in zip(low, high) ) * .05 or None
+        layout = graph.layout_fruchterman_reingold(weights=weights, niter=warm_niter,
+                    seed=positions, start_temp=start_temp, dim=self.dim)
+
+        # back to the previous bounding box
+        box = layout.boundaries()
+        scale = [ (high[d] - low[d]) / (box[1][d] - box[0][d]) if box[1][d] > box[0][d] and high[d] > low[d] else 1.
+                  for d in xrange(self.dim) ]
+        for i in xrange(len(layout)):
+            layout[i] = [ low[d] + (c - box[0][d]) * scale[d] for d, c in enumerate(layout[i]) ]
+        return layout
+
+
 # Layouts
-def layout_api(engines, api=None, optionables=None, prefix="layout"):
+def layout_api(engines, api=None, optionables=None, prefix="layout", cache=None, executor=None):
+    """ layout view over an edge list
+    :param cache: `LRUCache` of the layouts, see `CachedEngineView`
+    :param executor: `ProcessExecutor` running the layouts, None to run them in the request thread
+    """
         
     def export_layout(graph, layout):
         uuids = graph.vs['uuid']
@@ -91,21 +402,30 @@ def layout_api(engines, api=None, optionables=None, prefix="layout"):
         }
 
 
+    def seed_coords(request, graph):
+        """ previous coordinates sent with the request, see `WarmStartLayout` """
+        graph['coords'] = request.get('coords') or {}
+        return graph
+
     def layout_engine(layouts):
         """ Return a default engine over a lexical graph 
         """
         # setup
-        engine = Engine("gbuilder", "layout", "export")
+        engine = Engine("gbuilder", "seed", "layout", "export")
         engine.gbuilder.setup(in_name="request", out_name="graph", hidden=True)
+        engine.seed.setup(in_name=["request", "graph"], out_name="graph", hidden=True)
         engine.layout.setup(in_name="graph", out_name="layout")
         engine.export.setup(in_name=["graph", "layout"], out_name="layout", hidden=True)
         
         engine.gbuilder.set(engines.edge_subgraph) 
+        engine.seed.set(seed_coords)
 
         for k,v in layouts:
             v.name = k
             
         layouts = [ l for n,l in layouts ]        
+        if executor is not None:
+            layouts = [ Offloaded(l, executor) for l in layouts ]
         engine.layout.set( *layouts )        
         engine.export.set( export_layout )
 
@@ -119,8 +439,8 @@ def layout_api(engines, api=None, optionables=None, prefix="layout"):
 
     LAYOUTS = [
 
-        ("2D_Force_directed" , FruchtermanReingoldLayout(dim=2, weighted=True) ),
-        ("3D_Force_directed" , FruchtermanReingoldLayout(dim=3, weighted=True) ),
+        ("2D_Force_directed" , WarmStartLayout(FruchtermanReingoldLayout(dim=2, weighted=True), dim=2) ),
+        ("3D_Force_directed" , WarmStartLayout(FruchtermanReingoldLayout(dim=3, weighted=True), dim=3) ),
 
         ("2D_KamadaKawai" , KamadaKawaiLayout(dim=2) ),
         ("3D_KamadaKawai" , KamadaKawaiLayout(dim=3) ),
@@ -144,7 +464,7 @@ def layout_api(engines, api=None, optionables=None, prefix="layout"):
         api = ReliureAPI(name,expose_route = False)
     if optionables == None : optionables = LAYOUTS
     
-    view = EngineView(layout_engine(optionables))
+    view = CachedEngineView(layout_engine(optionables), cache=cache)
     view.set_input_type(EdgeList())
     view.add_output("layout", lambda x:x)
 
@@ -153,18 +473,35 @@ def layout_api(engines, api=None, optionables=None, prefix="layout"):
 
 
 # Clusters
-def clustering_api(engines, api=None, optionables=None, prefix="clustering"):
+def clustering_api(engines, api=None, optionables=None, prefix="clustering", cache=None, executor=None):
+    """ clustering view over an edge list
+    the request may give the `previous` clustering, { uuid: cluster id },
+    and the uuids of the nodes whose edges `changed` since, to re-cluster
+    only the touched communities, see `IncrementalClustering`.
+    :param cache: `LRUCache` of the clusterings, see `CachedEngineView`
+    :param executor: `ProcessExecutor` running the clusterings, None to run them in the request thread
+    """
+
+    def seed_previous(request, graph):
+        graph['previous'] = request.get('previous') or {}
+        graph['changed'] = request.get('changed') or []
+        return graph
         
     def clustering_engine(optionables):
         """ Return a default engine over a lexical graph
         """
         # setup
-        engine = Engine("gbuilder", "clustering", "labelling")
+        engine = Engine("gbuilder", "seed", "clustering", "labelling")
         engine.gbuilder.setup(in_name="request", out_name="graph", hidden=True)
+        engine.seed.setup(in_name=["request", "graph"], out_name="graph", hidden=True)
         engine.clustering.setup(in_name="graph", out_name="clusters")
         engine.labelling.setup(in_name="clusters", out_name="clusters", hidden=True)
 
         engine.gbuilder.set(engines.edge_subgraph) 
+        engine.seed.set(seed_previous)
+        optionables = [ IncrementalClustering(o) for o in optionables ]
+        if executor is not None:
+            optionables = [ Offloaded(o, executor) for o in optionables ]
         engine.clustering.set(*optionables)
 
         ## Labelling
@@ -195,7 +532,7 @@ def clustering_api(engines, api=None, optionables=None, prefix="clustering"):
 
     if optionables == None : optionables = DEFAULTS
     
-    view = EngineView(clustering_engine(optionables))
+    view = CachedEngineView(clustering_engine(optionables), cache=cache)
     view.set_input_type(EdgeList())
     view.add_output("clusters", export_clustering,  vertex_id_attr='uuid')
 
@@ -203,11 +540,18 @@ def clustering_api(engines, api=None, optionables=None, prefix="clustering"):
     return api
 
 
-def explore_api(name, graphdb, engines):
+def explore_api(name, graphdb, engines, dump_cache=None, starred=None, max_starred_size=2000000):
     """ API over tmuse elastic search
+    :param dump_cache: `DumpCache` of the graph dumps, shared with the edition api by default
+    :param starred: `StarredSets` of the starred nodes, shared with the edition api by default
+    :param max_starred_size: max number of vertices and edges of the starred graphs held in memory
     """
     api = ReliureAPI(name,expose_route=True)
 
+    if dump_cache is None : dump_cache = cache_module.dumps
+    if starred is None : starred = cache_module.starred
+    revisions = dump_cache.revisions
+
     # starred 
     view = EngineView(engines.starred_engine(graphdb))
     view.set_input_type(ComplexQuery())
@@ -240,7 +584,6 @@ def explore_api(name, graphdb, engines):
     api.register_view(view, url_prefix="additive_nodes")
 
     import random
-    import json
     import pickle
     from flask import request, jsonify
     from flask import Response, make_response
@@ -249,16 +592,96 @@ def explore_api(name, graphdb, engines):
     @api.route("/<string:gid>.json", methods=['GET'])
     @api.route("/starred/<string:gid>.json", methods=['GET'])
     def _json_dump(gid):
-        dumps = lambda g : json.dumps( export_graph(g, id_attribute='uuid') )
-        return stargraph_dump(gid, dumps, 'json')
+        """ streams the json starred graph, gzipped if the client accepts it
+        and `?gzip` is not `false`
+        """
+        dumps = lambda g : iter_graph_json(g, id_attribute='uuid')
+        return stargraph_dump(gid, dumps, 'json', stream=True)
 
     @api.route("/<string:gid>.pickle", methods=['GET'])
     @api.route("/starred/<string:gid>.pickle", methods=['GET'])
     def _pickle_dump(gid):
         return stargraph_dump(gid, pickle.dumps, 'pickle')
 
-    def stargraph_dump(gid, dumps, content_type):
-        """ returns igraph pickled/jsonified starred graph  """
+    @api.route("/<string:gid>.columns", methods=['GET'])
+    @api.route("/starred/<string:gid>.columns", methods=['GET'])
+    def _columns_dump(gid):
+        """ columnar binary starred graph, see `pdgapi.columnar` """
+        return stargraph_dump(gid, columnar.dumps, 'columns')
+
+    def stargraph_dump(gid, dumps, content_type, stream=False):
+        """ returns igraph pickled/jsonified starred graph
+        dumps are cached until the graph is edited, and revalidated with etag
+        and last modification date.
+        :param stream: `dumps` returns an iterable of strings, sent as they come
+        """
+        revision = revisions.revision(gid)
+        etag = revisions.etag(gid, content_type)
+        last_modified = revisions.last_modified(gid)
+
+        if request.if_none_match.contains(etag) or ( not request.if_none_match \
+           and request.if_modified_since is not None and last_modified <= request.if_modified_since ):
+            response = Response(status=304)
+
+        else:
+            data = dump_cache.get(gid, content_type, revision)
+
+            if data is None:
+                graph = starred_graph(gid)
+                if stream:
+                    data = dump_cache.stream(gid, content_type, dumps(graph), revision)
+                else :
+                    data = dumps(graph)
+                    dump_cache.set(gid, content_type, data, revision)
+
+            if stream:
+                chunks = [data] if isinstance(data, str) else data
+                gzipped = request.args.get('gzip', "") != "false" \
+                      and 'gzip' in request.headers.get('Accept-Encoding', "")
+                if gzipped:
+                    chunks = iter_gzip(chunks)
+                response = Response(chunks)
+                if gzipped:
+                    response.headers['Content-Encoding'] = 'gzip'
+            else :
+                response = make_response(data)
+
+            response.headers['Content-Type'] = 'application/%s' % content_type
+            response.headers['Content-Disposition'] = 'inline; filename=%s.%s' % (gid, content_type)
+
+        if stream:
+            response.headers['Vary'] = 'Accept-Encoding'
+        response.set_etag(etag)
+        response.last_modified = last_modified
+        return response
+
+    def load_starred(gid):
+        """ uuids of the starred nodes, the vertices of the starred graph """
+        graph = starred_graph(gid)
+        return graph.vs['uuid'] if 'uuid' in graph.vs.attributes() else []
+
+    @api.route("/starred/<string:gid>/nodes", methods=['GET'])
+    def starred_nodes(gid):
+        """ uuids of the starred nodes of the graph """
+        uuids = starred.starred(gid, load_starred)
+        return jsonify({ 'graph': gid, 'nodes': uuids, 'count': len(uuids) })
+
+    @api.route("/starred/<string:gid>/node/<string:uuid>", methods=['GET'])
+    def is_starred(gid, uuid):
+        return jsonify({ 'graph': gid, 'uuid': uuid, 'star': starred.contains(gid, uuid, load_starred) })
+
+    # starred graphs by revision, one query serves all the dump formats
+    # and the starred set
+    starred_graphs = LRUCache(max_size=max_starred_size, ttl=revisions.ttl,
+                              sizeof=lambda graph: graph.vcount() + graph.ecount())
+    revisions.listen(lambda gid: starred_graphs.discard(lambda key: key[0] == gid))
+
+    def starred_graph(gid):
+        """ starred igraph with the graph metadata as attributes """
+        revision = revisions.revision(gid)
+        graph = starred_graphs.get((gid, revision))
+        if graph is not None:
+            return graph
 
         engine = engines.starred_engine(graphdb)
         
@@ -268,10 +691,8 @@ def explore_api(name, graphdb, engines):
         for k,v in meta.iteritems():
             graph[k] = v
 
-        response = make_response(dumps(graph))
-        response.headers['Content-Type'] = 'application/%s' % content_type
-        response.headers['Content-Disposition'] = 'inline; filename=%s.%s' % (gid, content_type)
-        return response
+        starred_graphs.set((gid, revision), graph)
+        return graph
         
 
     @api.route("/<string:gid>/random")
@@ -1,19 +1,115 @@
 #-*- coding:utf-8 -*-
 
-from flask import request, jsonify, current_app, url_for
+from flask import request, jsonify, current_app, url_for, Response, stream_with_context
 from flask_login import login_required , current_user
 
 import json
+import base64
+import hashlib
 from reliure.web import ReliureAPI
 
 from pdglib.graphdb_interface import GraphError, ApiError
-
-
-
-def graphedit_api(name, app, graphdb, login_manager, socketio):
-    """ graph  api """
+try:
+    from pdglib.graphdb_interface import NodeNotFoundError
+except ImportError:
+    # backends without a dedicated error report unknown nodes as lookup errors
+    NodeNotFoundError = LookupError
+
+from pdgapi import cache
+from pdgapi.votes import VoteAggregator
+
+
+# events a created edge is fanned out to
+NEW_EDGE_ACTIONS = ("new edge", "new edge from", "new edge to")
+
+# orders of the graph listing
+GRAPH_ORDERS = ("name", "date", "votes", "size")
+
+# newline delimited json, used by the streaming imports
+NDJSON = "application/x-ndjson"
+
+
+def iter_ndjson(stream):
+    """ yields the json objects of a newline delimited json stream """
+    for line in iter(stream.readline, b""):
+        line = line.strip()
+        if line:
+            yield json.loads(line)
+
+def item_key(item):
+    """ sort key of a result item, its uuid when it has one """
+    if isinstance(item, dict) and 'uuid' in item:
+        return item['uuid']
+    return hashlib.sha1(json.dumps(item, sort_keys=True)).hexdigest()
+
+def query_hash(*query):
+    return hashlib.sha1(json.dumps(query, sort_keys=True)).hexdigest()[:12]
+
+def encode_cursor(offset, key, query):
+    """ opaque cursor resuming a listing after the item `key` """
+    return base64.urlsafe_b64encode(json.dumps([offset, key, query]))
+
+def decode_cursor(cursor, query):
+    """ :returns: (offset, key) of a cursor given for the same `query` """
+    try:
+        offset, key, hashed = json.loads(base64.urlsafe_b64decode(str(cursor)))
+    except (TypeError, ValueError):
+        raise ApiError("Invalid cursor")
+    if hashed != query:
+        raise ApiError("Cursor does not match the query")
+    return int(offset), key
+
+def cursor_page(fetch, query, cursor=None, start=0, size=100):
+    """ one page of a listing, resumed from `cursor` if any
+    :param fetch: function (start, size) giving the items
+    :returns: (start, items, next cursor or None)
+
+    A cursor remembers the offset and the last item sent. The backend pages
+    by offset, so a resumed page is fetched from the row of the last item,
+    one row more than the page: when that item moved by rows added or
+    removed before it, the page starts right after it if it is still in
+    the fetched rows, at the offset otherwise.
+    """
+    if cursor:
+        offset, last = decode_cursor(cursor, query)
+        base = max(offset - 1, 0)
+        items = fetch(base, size + offset - base)
+        full = len(items) >= size + offset - base
+        keys = [ item_key(item) for item in items ]
+        skip = keys.index(last) + 1 if last in keys else offset - base
+        start = base + skip
+        items = items[skip:skip + size]
+    else :
+        items = fetch(start, size)
+        full = len(items) >= size
+
+    cursor = None
+    if len(items) and full:
+        cursor = encode_cursor(start + len(items), item_key(items[-1]), query)
+    return start, items, cursor
+
+def chunked(iterable, size):
+    """ yields lists of at most `size` items """
+    chunk = []
+    for item in iterable:
+        chunk.append(item)
+        if len(chunk) >= size:
+            yield chunk
+            chunk = []
+    if len(chunk):
+        yield chunk
+
+
+def graphedit_api(name, app, graphdb, login_manager, socketio, revisions=None, starred=None):
+    """ graph  api
+    :param revisions: `GraphRevisions` bumped on every graph edition
+    :param starred: `StarredSets` updated by the star editions
+    """
     api = ReliureAPI(name,expose_route = False)
 
+    if revisions is None : revisions = cache.revisions
+    if starred is None : starred = cache.starred
+
     infos = {
             "desc" : "graph api",
             "version" : "0.1dev",
@@ -22,6 +118,8 @@ def graphedit_api(name, app, graphdb, login_manager, socketio):
         }
     print( infos )
 
+    # max items per page of find_nodes
+    max_page_size = app.config.get('PAGE_SIZE_MAX', 100)
 
     def make_pad_url(name):
         return ""
@@ -31,6 +129,113 @@ def graphedit_api(name, app, graphdb, login_manager, socketio):
  
     def broadcast_multi(messages):
         if socketio: socketio.broadcast_multi( messages )
+
+    def touch(gid):
+        """ marks the graph as modified, invalidates cached dumps """
+        revisions.bump(gid)
+
+    def load_completion(gid, obj_type, limit=None, page=1000):
+        """ the completion entries of a graph, stops past `limit` entries """
+        entries, start = [], 0
+        while True:
+            found = graphdb.complete_label(gid, obj_type, "", start, page)
+            entries.extend(found)
+            if len(found) < page or (limit is not None and len(entries) > limit):
+                return entries
+            start += page
+
+    def refresh_completion(gid, uuid, label, page=1000):
+        def fetch(obj_type):
+            """ the entry of `uuid` among all the matches of `label` """
+            start = 0
+            while True:
+                found = graphdb.complete_label(gid, obj_type, label, start, page)
+                for entry in found:
+                    if entry.get('uuid') == uuid:
+                        return [entry]
+                if len(found) < page:
+                    return []
+                start += page
+        completion.refresh(gid, uuid, fetch)
+
+    completion = cache.CompletionIndexes(load_completion, graphdb.complete_label,
+                        max_entries=app.config.get('COMPLETION_INDEX_SIZE', 1000000),
+                        folding=cache.fold if app.config.get('COMPLETION_FOLDING', True) else None )
+
+    degrees = cache.DegreeIndex(
+                    lambda gid, uuid, mode: graphdb.count_neighbors(gid, uuid, filter_edges=None, filter_nodes=None, filter_properties=None, mode=mode ),
+                    max_entries=app.config.get('DEGREE_INDEX_SIZE', 1000000),
+                    ttl=app.config.get('DEGREE_INDEX_TTL', 60) )
+
+    # schema version of the graphs, and responses cached until it changes
+    # schema editions of other processes are seen after SCHEMA_TTL seconds at most
+    schema_ttl = app.config.get('SCHEMA_TTL', 60)
+    schemas = cache.GraphRevisions(ttl=schema_ttl)
+    schema_responses = cache.LRUCache(max_entries=app.config.get('SCHEMA_CACHE_SIZE', 10000), ttl=schema_ttl)
+    schemas.listen(lambda gid: schema_responses.discard(lambda key: key[0] == gid))
+
+    def schema_response(gid, compute, *parts):
+        """ json response of `compute()`, cached until the schema of the
+        graph changes, and revalidated with its etag
+        :param parts: what identifies the response besides the graph
+        """
+        etag = schemas.etag(gid, request.path, *parts)
+
+        if request.if_none_match.contains(etag):
+            response = Response(status=304)
+        else :
+            body = schema_responses.get((gid, etag))
+            if body is None:
+                body = jsonify(compute()).get_data()
+                schema_responses.set((gid, etag), body, size=1)
+            response = Response(body, mimetype="application/json")
+
+        response.set_etag(etag)
+        response.last_modified = schemas.last_modified(gid)
+        return response
+
+    # pages of the graph listing : (order, page, reverse) : body
+    graph_lists = cache.LRUCache(max_entries=app.config.get('GRAPH_LIST_CACHE_SIZE', 1000),
+                                 ttl=app.config.get('GRAPH_LIST_TTL', 60))
+
+    def graphs_changed(*orders):
+        """ drops the listing pages in `orders`, all of them by default """
+        graph_lists.discard(lambda key: not orders or key[0] in orders)
+
+    # any edition may change the size and modification date of a graph
+    revisions.listen(lambda gid: graphs_changed("size", "date"))
+
+    # votes are written to the db by batches
+    votes = VoteAggregator( graphdb.get_user_updownvote_graph,
+                            graphdb.toggle_user_updownvote_graph,
+                            interval=app.config.get('VOTE_FLUSH_INTERVAL', 2.),
+                            ttl=app.config.get('VOTE_TTL', 60.),
+                            on_flush=lambda gids: graphs_changed("votes") )
+
+    def vote_data(gid, username, vote):
+        """ the vote data of the db, with the vote of the user and the
+        votes of the graph not flushed yet """
+        record = votes.record(username, gid)
+        data = dict(record) if isinstance(record, dict) else {}
+        data.update({ 'graph': gid,
+                      'username': username,
+                      'vote': vote,
+                      'pending': votes.pending(gid),
+                    })
+        return data
+
+    def new_edges_message(gid, username, edges, uuids):
+        """ one compact 'new edges' event for a batch of created edges
+        shared fields are sent once, each edge lists the `actions` it should
+        be fanned out to by the notification server
+        """
+        return {
+            "action": "new edges",
+            "graph": gid,
+            "username": username,
+            "status": "created",
+            "edges": [ dict(edges[i], uuid=uuid, actions=NEW_EDGE_ACTIONS) for i, uuid in uuids ],
+        }
  
 
     """ Graph """
@@ -38,10 +243,23 @@ def graphedit_api(name, app, graphdb, login_manager, socketio):
     @api.route("/list", methods=['GET'])
     @api.route("/list/page/<int:page>", methods=['GET'])
     def http_list(page=1, order_by="name"):
+        """ one page of the graph listing, `?order=` name, date, votes or size
+        pages are cached until a graph they may list changes
+        """
         offset = 30
-        data = graphdb.list_graphs(page, offset=offset, order_by=order_by, meta=False, reverse=False, root_page_url=url_for("%s.http_list" % api.name) )
-
-        return jsonify( data )
+        order_by = request.args.get('order', order_by)
+        reverse = request.args.get('reverse', "") == "true"
+        if order_by not in GRAPH_ORDERS:
+            raise ApiError("can not order graphs by %s" % order_by)
+
+        key = (order_by, page, reverse)
+        body = graph_lists.get(key)
+        if body is None:
+            data = graphdb.list_graphs(page, offset=offset, order_by=order_by, meta=False, reverse=reverse, root_page_url=url_for("%s.http_list" % api.name) )
+            body = jsonify( data ).get_data()
+            graph_lists.set(key, body, size=1)
+
+        return Response(body, mimetype="application/json")
         
 
     @api.route("/create", methods=['POST'])
@@ -68,6 +286,9 @@ def graphedit_api(name, app, graphdb, login_manager, socketio):
             if gid == None : gid = form['name']
             
             g = graphdb.create_graph( username, gid, properties)
+            touch(gid)
+            schemas.bump(gid)
+            graphs_changed()
             properties['pad_url'] = make_pad_url(name)
             data['graph'] = gid
             data['status'] = 'created'
@@ -75,6 +296,9 @@ def graphedit_api(name, app, graphdb, login_manager, socketio):
 
         if request.method == "PUT" and gid is not None:
             graphdb.update_graph(username, gid, properties)
+            touch(gid)
+            schemas.bump(gid)
+            graphs_changed()
             data['status'] = 'edited'
             data['properties'] = properties
             broadcast( gid,'edit graph', data )
@@ -85,15 +309,19 @@ def graphedit_api(name, app, graphdb, login_manager, socketio):
     @api.route("/g/<string:gid>", methods=['GET'])
     def get_graph_metadata(gid):
         """ get  graph metadata  """
+        edgetypes = request.args.get('edgetypes', "") != "false"
+        nodetypes = request.args.get('nodetypes', "") != "false"
+
+        def compute():
+            data = { gid: graphdb.get_graph_metadata(gid) }
+            if not edgetypes :
+                data[gid].pop("edgetypes")
+            
+            if not nodetypes :
+                data[gid].pop("nodetypes")
+            return data
         
-        data = { gid: graphdb.get_graph_metadata(gid) }
-        if request.args.get('edgetypes', "") == "false" :
-            data[gid].pop("edgetypes")
-        
-        if request.args.get('nodetypes', "") == "false" :
-            data[gid].pop("nodetypes")
-        
-        return jsonify(data)
+        return schema_response(gid, compute, edgetypes, nodetypes)
 
     #@api.route("/g/<string:gid>/drop", methods=['GET'])
     @api.route("/g/<string:gid>", methods=['DELETE'])
@@ -107,6 +335,12 @@ def graphedit_api(name, app, graphdb, login_manager, socketio):
         if graph and app.config.get( "ALLOW_OWNER_DELETE_GRAPH" , False) and graph['meta']['owner'] == username:
             
             graphdb.destroy_graph(gid)
+            touch(gid)
+            completion.invalidate(gid)
+            degrees.invalidate(gid)
+            starred.invalidate(gid)
+            schemas.bump(gid)
+            graphs_changed()
             
             data = { 'graph': gid,
                      'status' : 'deleted'
@@ -158,10 +392,11 @@ def graphedit_api(name, app, graphdb, login_manager, socketio):
         if request.method == 'POST':
             obj_type = request.json.get('obj_type')
             prefix = request.json.get('prefix')
-            start = request.json.get('start')
+            start = request.json.get('start', start)
 
         start = int(start)
-        complete = graphdb.complete_label(gid, obj_type, prefix, start, 100)
+        # answered from the in memory index of the graph labels
+        complete = completion.complete(gid, obj_type, prefix, start, 100)
         data = {    "graph" : gid,
                     "obj_type"  : obj_type,
                     "prefix"  : prefix,
@@ -199,14 +434,14 @@ def graphedit_api(name, app, graphdb, login_manager, socketio):
     def get_schema(gid):
         """ Get graph schema """
 
-        data = { 'graph': gid,
+        compute = lambda : { 'graph': gid,
                  'schema' : {
                     "nodetypes" : graphdb.get_node_types(gid),
                     "edgetypes" : graphdb.get_edge_types(gid),
                  }
                }
 
-        return jsonify(data)
+        return schema_response(gid, compute)
 
     @api.route("/g/<string:gid>/schema", methods=['POST'])
     @login_required
@@ -224,7 +459,7 @@ def graphedit_api(name, app, graphdb, login_manager, socketio):
     #  NodeTypes
     @api.route("/g/<string:gid>/nodetypes", methods=['GET'])
     def get_node_types(gid):
-        return jsonify( { "graph": gid,
+        return schema_response(gid, lambda : { "graph": gid,
                           "nodetypes" : graphdb.get_node_types(gid),
                         }
                       )
@@ -234,10 +469,12 @@ def graphedit_api(name, app, graphdb, login_manager, socketio):
     def get_nodetype(gid, uuid):
         #username = current_user.username
 
-        nodetype = graphdb.get_node_type( gid, uuid ) 
-        nodetype.update({ 'graph': gid  })
+        def compute():
+            nodetype = graphdb.get_node_type( gid, uuid ) 
+            nodetype.update({ 'graph': gid  })
+            return nodetype
                
-        return jsonify(nodetype)
+        return schema_response(gid, compute)
 
 
 
@@ -278,6 +515,8 @@ def graphedit_api(name, app, graphdb, login_manager, socketio):
         if request.method == "POST" and uuid is None:
 
             nodetype = graphdb.create_node_type( username, gid, name, properties, description)
+            touch(gid)
+            schemas.bump(gid)
             nodetype.update(
                     {
                      'graph': gid,
@@ -293,6 +532,8 @@ def graphedit_api(name, app, graphdb, login_manager, socketio):
         elif request.method == "PUT" and uuid is not None :
 
             nodetype = graphdb.update_nodetype(uuid, properties, description)
+            touch(gid)
+            schemas.bump(gid)
             nodetype.update(
                     {
                      'graph': gid,
@@ -323,9 +564,8 @@ def graphedit_api(name, app, graphdb, login_manager, socketio):
 
     @api.route("/g/<string:gid>/edgetypes", methods=['GET'])
     def get_edgetypes(gid):
-        edgetypes = graphdb.get_edge_types(gid)
-        return jsonify( { "graph": gid,
-                          "edgetypes" : edgetypes,
+        return schema_response(gid, lambda : { "graph": gid,
+                          "edgetypes" : graphdb.get_edge_types(gid),
                         }
                       )
 
@@ -351,6 +591,8 @@ def graphedit_api(name, app, graphdb, login_manager, socketio):
         if  request.method == "POST" and  uuid is None :
 
             edgetype = graphdb.create_edge_type( username, gid, name, properties, description)
+            touch(gid)
+            schemas.bump(gid)
             edgetype.update(
                     {
                      'graph': gid,
@@ -366,6 +608,8 @@ def graphedit_api(name, app, graphdb, login_manager, socketio):
 
             #props = { x['name']: x['otype'] for x in properties }
             edgetype = graphdb.update_edgetype(uuid, properties, description)
+            touch(gid)
+            schemas.bump(gid)
             edgetype.update(
                     {
                      'graph': gid,
@@ -387,8 +631,14 @@ def graphedit_api(name, app, graphdb, login_manager, socketio):
     @api.route("/g/<string:gid>/nodes", methods=['POST'])
     @login_required
     def create_nodes(gid):
-        """ batch insert nodes """
+        """ batch insert nodes
+        a `application/x-ndjson` body, one node per line, is imported by chunks
+        see `import_nodes`
+        """
         username = current_user.username
+
+        if request.mimetype == NDJSON:
+            return import_nodes(gid, username)
         
         #print request.args
         #print request.values
@@ -406,11 +656,22 @@ def graphedit_api(name, app, graphdb, login_manager, socketio):
         for node in nodes: pass
 
         uuids = graphdb.batch_create_nodes(username, gid, nodes )
+        touch(gid)
+        completion.invalidate(gid)
 
         #assert len(uuids) == len(nodes)
 
         # post to Notifications Server
-        messages = [ {
+        broadcast_multi( new_nodes_messages(gid, username, nodes, uuids) )
+
+        return jsonify( {
+                          "action": "new node",
+                          'graph':gid,
+                          'username' : username,
+                          'results': uuids } )
+
+    def new_nodes_messages(gid, username, nodes, uuids):
+        return [ {
                     "username": username,
                     "action": "new node",
                     
@@ -421,36 +682,64 @@ def graphedit_api(name, app, graphdb, login_manager, socketio):
                     "status" : "created"
                     
                   } for i, uuid in uuids ]
-                  
-        broadcast_multi( messages )
-
-        return jsonify( {
-                          "action": "new node",
-                          'graph':gid,
-                          'username' : username,
-                          'results': uuids } )
-
 
+    def import_nodes(gid, username):
+        """ streaming nodes import
+        reads one node per line from the request body and creates them by
+        chunks of `?chunk=` nodes (default IMPORT_CHUNK_SIZE).
+        Streams back one json line per chunk :
+            { chunk: <int>, offset: <int>, count: <int>, results: [ (index, uuid), ... ] }
+        indexes are line numbers in the whole upload.
+        """
+        size = int(request.args.get('chunk', app.config.get('IMPORT_CHUNK_SIZE', 1000)))
+        if size < 1 : raise ApiError("chunk size should be positive")
+
+        def generate():
+            num, offset = 0, 0
+            try:
+                for nodes in chunked(iter_ndjson(request.stream), size):
+                    uuids = graphdb.batch_create_nodes(username, gid, nodes )
+                    touch(gid)
+                    completion.invalidate(gid)
+                    broadcast_multi( new_nodes_messages(gid, username, nodes, uuids) )
+
+                    yield json.dumps({ 'chunk': num,
+                                       'offset': offset,
+                                       'count': len(nodes),
+                                       'results': [ (offset + i, uuid) for i, uuid in uuids ] }) + "\n"
+                    num += 1
+                    offset += len(nodes)
+            except Exception as err:
+                # headers are gone, report the failing chunk in the stream
+                yield json.dumps({ 'chunk': num, 'offset': offset, 'error': str(err) }) + "\n"
+
+        return Response(stream_with_context(generate()), mimetype=NDJSON)
 
     @api.route("/g/<string:gid>/nodes/find", methods=['POST'])
     @api.route("/g/<string:gid>/nodes/find/<string:node_type>", methods=['GET'])
     def find_nodes(gid, node_type=None):
         """ Get node data
-        
+        pages with `start` and `size`, or with the `next` cursor of the
+        previous page given as `cursor`
         """
 
-        start=0; size=100; properties={}
+        start=0; size=100; properties={}; cursor=None
 
         if request.method == "GET":
             start = int(request.args.get('start', start))
+            size = min(int(request.args.get('size', size)), max_page_size)
+            cursor = request.args.get('cursor')
         if request.method == "POST":
             form = request.json
             start = form.get('start', 0)
-            size  = min(form.get('size', 10), 100)
+            size  = min(form.get('size', 10), max_page_size)
             node_type = form.get('nodetype')
             properties = form.get('properties')
+            cursor = form.get('cursor')
 
-        nodes = graphdb.find_nodes(gid, node_type, properties, start, size)
+        fetch = lambda start, size: graphdb.find_nodes(gid, node_type, properties, start, size)
+        query = query_hash('nodes', gid, node_type, properties)
+        start, nodes, next_cursor = cursor_page(fetch, query, cursor, start, size)
 
         data = { 'graph': gid,
                  'nodetype' : node_type, # uuid
@@ -459,7 +748,8 @@ def graphedit_api(name, app, graphdb, login_manager, socketio):
                  'properties' : properties,
                  #'uuids' : []
                  'nodes' : nodes,
-                 'count' : len(nodes)
+                 'count' : len(nodes),
+                 'next' : next_cursor,
                }
 
         return jsonify( data )
@@ -474,6 +764,10 @@ def graphedit_api(name, app, graphdb, login_manager, socketio):
 
     def _get_node(gid, uuid, by_name=False):
         """ Get node data """
+        return jsonify( read_node(gid, uuid, by_name) )
+
+    def read_node(gid, uuid, by_name=False):
+        """ node data, as answered by the node api """
 
         # TODO check node is in graph
     
@@ -482,13 +776,46 @@ def graphedit_api(name, app, graphdb, login_manager, socketio):
         else :
             node = graphdb.get_node(gid, uuid)
 
-        node.update( {
-            'graph': gid,
-            'label' if by_name else 'uuid' : uuid,
-            'status' : 'read'
-        })
+        if node:
+            node.update( {
+                'graph': gid,
+                'label' if by_name else 'uuid' : uuid,
+                'status' : 'read'
+            })
+
+        return node
+
+    @api.route("/g/<string:gid>/nodes/fetch", methods=['POST'])
+    def fetch_nodes(gid):
+        """ Get the data of many nodes
+        POST { uuids: [<uuid>, ...] } or { labels: [<str>, ...] }
+        :returns: { nodes: [...], missing: [...] } nodes in request order,
+            missing uuids or labels are not in `nodes`
+        """
+        form = request.json or {}
+        by_name = 'labels' in form
+        keys = form.get('labels' if by_name else 'uuids') or []
+        if not isinstance(keys, list) or not all( isinstance(key, basestring) for key in keys ):
+            raise ApiError("uuids or labels should be a list of strings")
+        max_size = app.config.get('FETCH_NODES_MAX', 1000)
+        if len(keys) > max_size:
+            raise ApiError("can not fetch more than %s nodes at once" % max_size)
+
+        found = {}
+        for key in set(keys):
+            try:
+                node = read_node(gid, key, by_name)
+            except NodeNotFoundError:
+                node = None
+            if node:
+                found[key] = node
 
-        return jsonify( node )
+        data = { 'graph': gid,
+                 'nodes': [ found[key] for key in keys if key in found ],
+                 'missing': [ key for key in keys if key not in found ],
+               }
+
+        return jsonify( data )
 
     @api.route("/g/<string:gid>/node/<string:uuid>/neighbors", methods=['GET','POST'])
     def node_neigbhors( gid, uuid):
@@ -502,13 +829,19 @@ def graphedit_api(name, app, graphdb, login_manager, socketio):
         if request.method =='GET':
             start = int(request.args.get('start', 0))
             mode = request.args.get('mode', 'ALL')
+            cursor = request.args.get('cursor')
             
         elif  request.method =='POST':
             start = request.json.get('start', 0)
             mode = request.json.get('mode', 'ALL')
+            cursor = request.json.get('cursor')
 
-        
-        neighbors = graphdb.get_graph_neighbors(gid, uuid, filter_edges=None, filter_nodes=None, filter_properties=None, mode= mode, start=start, size=SIZE )
+        if not isinstance(mode, basestring) or mode.upper() not in degrees.MODES:
+            raise ApiError("unknown neighbors mode %s" % mode)
+
+        fetch = lambda start, size: graphdb.get_graph_neighbors(gid, uuid, filter_edges=None, filter_nodes=None, filter_properties=None, mode= mode, start=start, size=size )
+        query = query_hash('neighbors', gid, uuid, mode)
+        start, neighbors, next_cursor = cursor_page(fetch, query, cursor, start, SIZE)
 
         data = {
                 'graph' : gid,
@@ -518,7 +851,8 @@ def graphedit_api(name, app, graphdb, login_manager, socketio):
                 'neighbors' : neighbors,
                 'size' : SIZE,
                 'length' : len(neighbors),
-                'count' : graphdb.count_neighbors(gid, uuid, filter_edges=None, filter_nodes=None, filter_properties=None, mode=mode )
+                'count' : degrees.get(gid, uuid, mode),
+                'next' : next_cursor,
             }
         return jsonify( data )
 
@@ -531,18 +865,21 @@ def graphedit_api(name, app, graphdb, login_manager, socketio):
         :returns : neighbors count
         """
         if request.method =='GET':
-            pass
+            mode = request.args.get('mode', 'ALL')
         elif  request.method =='POST':
-            pass
+            mode = (request.json or {}).get('mode', 'ALL')
 
         # TODO parse args for filter
 
-        edges = graphdb.count_neighbors(uuid, filter_edges=None, filter_nodes=None, filter_properties=None, mode='ALL' )
+        if not isinstance(mode, basestring) or mode.upper() not in degrees.MODES:
+            raise ApiError("unknown neighbors mode %s" % mode)
+        count = degrees.get(gid, uuid, mode)
 
         data = {
                 'graph' : gid,
                 'node'  : uuid,
-                'neighbors': edges
+                'mode' : mode,
+                'neighbors': count
             }
         return jsonify( data )
 
@@ -596,6 +933,8 @@ def graphedit_api(name, app, graphdb, login_manager, socketio):
         if uuid is None and request.method == "POST" :
 
             uuid = graphdb.create_node(username, gid, nt_uuid, props)
+            touch(gid)
+            if 'label' in props: refresh_completion(gid, uuid, label)
             resp['uuid'] = uuid
             resp['status'] = "created"
             resp['label'] = label
@@ -607,6 +946,8 @@ def graphedit_api(name, app, graphdb, login_manager, socketio):
         elif uuid and request.method == "PUT" :
             # TODO:: check that node belongs to this graph
             graphdb.change_node_properties(username, uuid, props)
+            touch(gid)
+            if 'label' in props: refresh_completion(gid, uuid, label)
 
             resp['status'] = "edited"
             resp['label'] = label
@@ -632,6 +973,11 @@ def graphedit_api(name, app, graphdb, login_manager, socketio):
         node = graphdb.get_node(gid, uuid)
 
         deleted = graphdb.delete_node(current_user.username, gid, uuid)
+        touch(gid)
+        completion.remove(gid, uuid)
+        starred.update(gid, [uuid], False)
+        # its neighbors lost an edge
+        degrees.invalidate(gid)
 
         data = {
                  'graph': gid,
@@ -648,14 +994,18 @@ def graphedit_api(name, app, graphdb, login_manager, socketio):
 
     # ~~~ Stars ~~~
     
-    def _set_nodes_starred(gid, nodes, starred):
-
-        graphdb.set_nodes_starred(gid, nodes, starred)
+    def _set_nodes_starred(gid, nodes, star):
+        """ stars or unstars nodes, written by chunks of STAR_CHUNK_SIZE """
+        size = app.config.get('STAR_CHUNK_SIZE', 1000)
+        for chunk in chunked(nodes, size):
+            graphdb.set_nodes_starred(gid, chunk, star)
+            starred.update(gid, chunk, star)
+        touch(gid)
 
         data = { 'graph': gid,
                  'nodes' : nodes,
                  'count' : len(nodes),
-                 'star' : starred
+                 'star' : star
                }
         return data
         
@@ -687,7 +1037,8 @@ def graphedit_api(name, app, graphdb, login_manager, socketio):
     def user_upvote_graph(gid):
         
         username = current_user.username if current_user.is_authenticated else ""
-        return jsonify( graphdb.toggle_user_updownvote_graph( username, gid, 'up' ))
+        vote = votes.vote_toggle( username, gid, 'up' )
+        return jsonify( vote_data(gid, username, vote) )
 
 
     @api.route("/g/<string:gid>/downvote", methods=['GET'])
@@ -695,16 +1046,21 @@ def graphedit_api(name, app, graphdb, login_manager, socketio):
     def user_downvote_graph(gid):
         
         username = current_user.username if current_user.is_authenticated else ""
-        return jsonify(
-            graphdb.toggle_user_updownvote_graph( username, gid , 'down')
-        )
+        vote = votes.vote_toggle( username, gid , 'down')
+        return jsonify( vote_data(gid, username, vote) )
         
     @api.route("/g/<string:gid>/vote", methods=['GET'])
     @login_required
     def get_user_graph_vote(gid):
         
         username = current_user.username if current_user.is_authenticated else ""
-        return jsonify( graphdb.get_user_updownvote_graph( username, gid) )
+        return jsonify( vote_data(gid, username, votes.vote(username, gid)) )
+
+    @api.route("/votes/stats", methods=['GET'])
+    def votes_stats():
+        """ vote flush counters, `flush_lag` is the age in seconds of the
+        oldest vote not written to the db """
+        return jsonify( votes.stats() )
 
 
 
@@ -730,46 +1086,101 @@ def graphedit_api(name, app, graphdb, login_manager, socketio):
     @api.route("/g/<string:gid>/edges", methods=['POST'])
     @login_required
     def edit_edges(gid):
+        """ batch insert edges
+        a `application/x-ndjson` body, one edge per line, is imported by chunks
+        see `import_edges`
+        """
+        if request.mimetype == NDJSON:
+            return import_edges(gid, current_user.username)
 
-        messages = []
         data = request.json
         
         edges = data['edges']
         uuids = graphdb.batch_create_edges(current_user.username, gid, edges )
+        touch(gid)
+        degrees.edges_changed(gid, edges)
 
-        for i, uuid in uuids:
-
-            edge = edges[i]
-            edge['uuid'] = uuid
-            
-            edge.update({
-                "graph": gid, 
-                "username":current_user.username,
-                "status" : "created",                
-            })
-                   
-            edge.update({
-                "action": "new edge",
-            })
-            messages.append(dict(edge))
-            
-            edge.update({
-                "action": "new edge from",
-            })
-            messages.append(dict(edge))
-
-            edge.update({
-                "action": "new edge to",
-            })
-            messages.append(dict(edge))
-            
-        broadcast_multi(messages)
+        broadcast_multi( [ new_edges_message(gid, current_user.username, edges, uuids) ] )
         
         return jsonify( { 'graph':gid,
                           'username' : current_user.username,
                           'status': 'created',
                           'results': uuids } )
 
+    def import_edges(gid, username):
+        """ streaming edges import
+        reads one edge per line from the request body :
+            { edgetype: <uuid>, properties: {},
+              source: <uuid> | source_label: <str>,
+              target: <uuid> | target_label: <str> }
+        labels are resolved once per request, edges are created by chunks
+        of `?chunk=` edges (default IMPORT_CHUNK_SIZE).
+        Streams back one json line per chunk :
+            { chunk: <int>, offset: <int>, count: <int>,
+              results: [ (index, uuid), ... ], missing: [ (index, label), ... ] }
+        indexes are line numbers in the whole upload, edges with an unknown
+        label are reported in `missing` and not created.
+        """
+        size = int(request.args.get('chunk', app.config.get('IMPORT_CHUNK_SIZE', 1000)))
+        if size < 1 : raise ApiError("chunk size should be positive")
+        memo_size = app.config.get('IMPORT_LABEL_MEMO', 100000)
+
+        memo = {} # label : uuid or None
+
+        def resolve(labels):
+            """ :returns: { label: uuid or None } for the labels of a chunk """
+            if len(memo) + len(labels) > memo_size: memo.clear()
+            resolved = {}
+            for label in labels:
+                if label not in memo:
+                    try:
+                        node = graphdb.get_node_by_name(gid, label)
+                    except NodeNotFoundError:
+                        node = None
+                    memo[label] = node['uuid'] if node else None
+                resolved[label] = memo[label]
+            return resolved
+
+        def generate():
+            num, offset = 0, 0
+            try:
+                for lines in chunked(iter_ndjson(request.stream), size):
+                    resolved = resolve(set( edge[k] for edge in lines for k in ('source_label', 'target_label') if k in edge ))
+
+                    edges, index, missing = [], [], []
+                    for i, edge in enumerate(lines):
+                        unknown = None
+                        for end in ('source', 'target'):
+                            label = edge.pop('%s_label' % end, None)
+                            if label is not None:
+                                edge[end] = resolved.get(label)
+                                if edge[end] is None: unknown = label
+                        if unknown is None:
+                            edges.append(edge)
+                            index.append(offset + i)
+                        else:
+                            missing.append((offset + i, unknown))
+
+                    uuids = []
+                    if len(edges):
+                        uuids = graphdb.batch_create_edges(username, gid, edges )
+                        touch(gid)
+                        degrees.edges_changed(gid, edges)
+                        broadcast_multi( [ new_edges_message(gid, username, edges, uuids) ] )
+
+                    yield json.dumps({ 'chunk': num,
+                                       'offset': offset,
+                                       'count': len(lines),
+                                       'results': [ (index[i], uuid) for i, uuid in uuids ],
+                                       'missing': missing }) + "\n"
+                    num += 1
+                    offset += len(lines)
+            except Exception as err:
+                # headers are gone, report the failing chunk in the stream
+                yield json.dumps({ 'chunk': num, 'offset': offset, 'error': str(err) }) + "\n"
+
+        return Response(stream_with_context(generate()), mimetype=NDJSON)
+
     @api.route("/g/<string:gid>/edges/find", methods=['POST'])
     def find_edges(gid):
         """ Get node data """
@@ -780,14 +1191,17 @@ def graphedit_api(name, app, graphdb, login_manager, socketio):
         edge_type = form.get('edge_type')
         properties = form.get('properties')
 
-        edges = graphdb.find_edges(gid, edge_type, properties, start, size)
+        fetch = lambda start, size: graphdb.find_edges(gid, edge_type, properties, start, size)
+        query = query_hash('edges', gid, edge_type, properties)
+        start, edges, next_cursor = cursor_page(fetch, query, form.get('cursor'), start, size)
 
         data = { 'graph': gid,
                  'edge_type' : edge_type,
                  'start' : start,
                  'size' : size,
                  'properties' : properties,
-                 'edges' : edges
+                 'edges' : edges,
+                 'next' : next_cursor,
                }
 
         return jsonify( data )
@@ -822,6 +1236,8 @@ def graphedit_api(name, app, graphdb, login_manager, socketio):
             assert source and target, "Wrong source or target for an edge (%s,%s) " % (source, target)
 
             uuid = graphdb.create_edge(username, gid, edgetype, props, source, target)
+            touch(gid)
+            degrees.edges_changed(gid, [ {'source': source, 'target': target} ])
             
             edge = graphdb.get_edge(uuid)
 
@@ -836,6 +1252,7 @@ def graphedit_api(name, app, graphdb, login_manager, socketio):
         elif uuid and request.method == "PUT":
             # edition
             graphdb.change_edge_properties(username, uuid, props)
+            touch(gid)
             
             edge = graphdb.get_edge(uuid)
 
@@ -859,7 +1276,10 @@ def graphedit_api(name, app, graphdb, login_manager, socketio):
         """ Delete edge """
 
         # TODO : mark edge deleted
+        edge = graphdb.get_edge(uuid)
         graphdb.delete_edge(current_user.username, gid, uuid)
+        touch(gid)
+        degrees.edges_changed(gid, [ edge ])
 
         data = {
                  'graph': gid,
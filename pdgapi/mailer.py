@@ -0,0 +1,232 @@
+#-*- coding:utf-8 -*-
+""" Background mail dispatcher """
+
+import os
+import json
+import time
+import uuid
+import errno
+import threading
+
+from Queue import Full
+
+from flask_mail import Message
+
+from pdgapi.workers import WorkerQueue
+
+
+class MailDispatcher(WorkerQueue):
+    """ Sends mails from background worker threads.
+
+    Mails are queued by `send` and delivered by batches over one SMTP
+    connection, failed deliveries are retried with an exponential backoff.
+    With a spool directory every queued mail is also written on disk until
+    it is delivered. Spool files are named after the process that queued
+    them, mails left by a process that is gone are claimed by renaming
+    their file, so that only one process queues them again.
+
+    :param app: flask app, mails are sent in its context
+    :param mail: `flask_mail.Mail`
+    :param sink: "smtp" to send mails, "memory" to keep them in `outbox`,
+        or a file path where they are appended
+    :param path: spool directory, None to keep the queue in memory only
+    :param workers: number of delivery threads, 0 to send synchronously
+    :param queue_size: max number of pending mails
+    :param batch_size: max number of mails sent over one connection
+    :param retries: max delivery attempts of a mail
+    :param backoff: seconds before the first retry, doubled on every retry
+    """
+
+    def __init__(self, app, mail, sink="smtp", path=None, workers=1, queue_size=1000,
+                       batch_size=20, retries=5, backoff=2.):
+        self.app = app
+        self.mail = mail
+        self.sink = sink
+        self.path = path
+        self.retries = retries
+        self.backoff = backoff
+        WorkerQueue.__init__(self, workers, queue_size, batch_size, name="mailer",
+                             counters={ 'queued': 0, 'sent': 0, 'retried': 0, 'failed': 0, 'send_time': 0., 'last_send_time': 0. })
+
+        self.outbox = []
+
+        if path is not None:
+            if not os.path.isdir(path):
+                os.makedirs(path)
+            for name in sorted(os.listdir(path)):
+                if name.endswith(".json"):
+                    self._claim(name)
+
+    def send(self, message):
+        """ queues a `flask_mail.Message`, raises `Queue.Full` if the queue is full """
+        job = { 'id': uuid.uuid4().hex,
+                'time': time.time(),
+                'attempts': 0,
+                'mail': { 'sender': message.sender,
+                          'recipients': list(message.recipients),
+                          'subject': message.subject,
+                          'body': message.body,
+                        }
+              }
+        if self.workers <= 0:
+            if len(self._deliver([job])):
+                raise IOError("can't send mail to %s" % ", ".join(job['mail']['recipients']))
+            return
+
+        self._start()
+        self._spool(job)
+        try:
+            self._queue.put_nowait(job)
+        except Full:
+            self._unspool(job)
+            raise
+        self._count('queued')
+
+    def stats(self):
+        """ delivery counters, queue depth and send latency in seconds """
+        stats = WorkerQueue.stats(self)
+        stats['mean_send_time'] = stats['send_time'] / max(stats['sent'], 1)
+        return stats
+
+    # delivery
+
+    def _process(self, jobs):
+        for job in self._deliver(jobs):
+            self._retry(job)
+
+    def _deliver(self, jobs):
+        """ sends the mails of `jobs` :returns: jobs that failed """
+        pending, failed = list(jobs), []
+        with self.app.app_context():
+            connection = None
+            try:
+                if self.sink == "smtp":
+                    connection = self.mail.connect()
+                    connection.__enter__()
+                while len(pending):
+                    job = pending[0]
+                    start = time.time()
+                    try:
+                        self._send(connection, job['mail'])
+                    except Exception as e:
+                        print "can't send mail to", job['mail']['recipients'], e
+                        failed.append(pending.pop(0))
+                        if connection is not None:
+                            # the connection may be broken, open another one
+                            self._close(connection)
+                            connection = None
+                            connection = self.mail.connect()
+                            connection.__enter__()
+                        continue
+                    pending.pop(0)
+                    elapsed = time.time() - start
+                    with self._lock:
+                        self._counters['sent'] += 1
+                        self._counters['send_time'] += elapsed
+                        self._counters['last_send_time'] = elapsed
+                    self._unspool(job)
+            except Exception as e:
+                print "can't connect to the mail server", e
+            finally:
+                if connection is not None:
+                    self._close(connection)
+        return failed + pending
+
+    @staticmethod
+    def _close(connection):
+        try:
+            connection.__exit__(None, None, None)
+        except Exception:
+            pass
+
+    def _send(self, connection, mail):
+        if self.sink == "smtp":
+            message = Message(sender=tuple(mail['sender']) if isinstance(mail['sender'], list) else mail['sender'])
+            message.recipients = mail['recipients']
+            message.subject = mail['subject']
+            message.body = mail['body']
+            connection.send(message)
+        elif self.sink == "memory":
+            self.outbox.append(mail)
+        else :
+            with open(self.sink, 'a') as f:
+                f.write(json.dumps(mail) + "\n")
+
+    def _retry(self, job):
+        job['attempts'] += 1
+        if job['attempts'] >= self.retries:
+            self._count('failed')
+            self._unspool(job, failed=True)
+            return
+        self._count('retried')
+        self._spool(job)
+        delay = self.backoff * 2 ** (job['attempts'] - 1)
+        timer = threading.Timer(delay, self._requeue, (job,))
+        timer.daemon = True
+        timer.start()
+
+    def _requeue(self, job):
+        try:
+            self._queue.put_nowait(job)
+        except Full:
+            self._count('failed')
+            self._unspool(job, failed=True)
+
+    # spool
+
+    def _filename(self, job, pid=None):
+        """ spool file of `job`, owned by the process `pid`, this one by default """
+        pid = os.getpid() if pid is None else pid
+        return os.path.join(self.path, "%d-%s.%s.json" % (job['time'] * 1000, job['id'], pid))
+
+    def _spool(self, job):
+        if self.path is None: return
+        filename = self._filename(job)
+        with open(filename + ".tmp", 'w') as f:
+            json.dump(job, f)
+        os.rename(filename + ".tmp", filename)
+
+    def _unspool(self, job, failed=False):
+        if self.path is None: return
+        filename = self._filename(job)
+        try:
+            if failed:
+                os.rename(filename, filename[:-len(".json")] + ".failed")
+            else :
+                os.remove(filename)
+        except OSError:
+            pass
+
+    def _claim(self, name):
+        """ queues the mail spooled in `name` if its process is gone """
+        parts = name[:-len(".json")].split(".")
+        if len(parts) == 2:
+            try:
+                owner = int(parts[1])
+                if owner != os.getpid():
+                    os.kill(owner, 0)
+                    # still sending it
+                    return
+            except ValueError:
+                pass
+            except OSError as err:
+                if err.errno != errno.ESRCH:
+                    return
+        filename = os.path.join(self.path, name)
+        claimed = os.path.join(self.path, "%s.%s.json" % (parts[0], os.getpid()))
+        try:
+            # fails if another process claimed it first
+            os.rename(filename, claimed)
+        except OSError:
+            return
+        self._load(claimed)
+
+    def _load(self, filename):
+        try:
+            with open(filename) as f:
+                job = json.load(f)
+            self._queue.put_nowait(job)
+            self._count('queued')
+            self._start()
+        except (IOError, ValueError, Full) as e:
+            print "can't load queued mail", filename, e
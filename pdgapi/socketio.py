@@ -1,49 +1,205 @@
+import time
 import threading
 import requests
 import datetime
 
+from requests.adapters import HTTPAdapter
 
-class Socketio(object):
-    
-    def __init__(self, host="http://localhost:3000" ):
+from Queue import Full
+
+from pdgapi.workers import WorkerQueue
+
+
+# channel of the jobs posted to `multi_events`
+MULTI = object()
+
+
+class CircuitBreaker(object):
+    """ Stops calling a failing server for `cooldown` seconds
+    after `threshold` consecutive failures.
+
+    Once the cooldown is over one call is let through, its outcome closes
+    or re-opens the circuit.
+    """
+
+    def __init__(self, threshold=5, cooldown=30.):
+        self.threshold = threshold
+        self.cooldown = cooldown
+
+        self.failures = 0
+        self.opened_at = None
+        self._trial = False
+        self._lock = threading.Lock()
+
+    @property
+    def state(self):
+        if self.opened_at is None:
+            return "closed"
+        if time.time() - self.opened_at < self.cooldown:
+            return "open"
+        return "half-open"
+
+    def allow(self):
+        """ :returns: False if the call should fail fast """
+        with self._lock:
+            state = self.state
+            if state == "closed":
+                return True
+            if state == "half-open" and not self._trial:
+                self._trial = True
+                return True
+            return False
+
+    def success(self):
+        with self._lock:
+            self.failures = 0
+            self.opened_at = None
+            self._trial = False
+
+    def failure(self):
+        """ :returns: True if this failure opened the circuit """
+        with self._lock:
+            self.failures += 1
+            reopen = self._trial
+            self._trial = False
+            if reopen or (self.opened_at is None and self.failures >= self.threshold):
+                self.opened_at = time.time()
+                return True
+            return False
+
+class Socketio(WorkerQueue):
+    """ Client for the node notification server.
+
+    Events are queued and posted by background worker threads, so that
+    write requests only pay the cost of a `Queue.put`.
+    Pending `broadcast_multi` messages are merged into a single
+    `multi_events` post of at most `batch_size` messages.
+
+    :param host: notification server url
+    :param workers: number of delivery threads, 0 to post synchronously.
+        A single worker posts events in queue order, with more workers
+        events may be delivered out of order
+    :param queue_size: max number of pending events, extra events are dropped
+    :param batch_size: max number of messages merged in one post
+    :param pool_size: max number of keep-alive connections to the server
+    :param breaker: `CircuitBreaker` guarding the server, False to disable
+    """
+
+    def __init__(self, host="http://localhost:3000", workers=1, queue_size=10000, batch_size=500, timeout=0.2,
+                       pool_size=4, breaker=True ):
         self.host = host
         self.new_event =  "%s/new_event/" % host
         self.multi_events = "%s/multi_events" % host
-        
+
+        self.timeout = timeout
+        WorkerQueue.__init__(self, workers, queue_size, batch_size, name="socketio",
+                             counters={ 'queued': 0, 'dropped': 0, 'sent': 0, 'posts': 0, 'errors': 0, 'rejected': 0 })
+
+        # keep-alive connections, never more than pool_size
+        self._adapter = HTTPAdapter(pool_connections=1, pool_maxsize=pool_size, pool_block=True, max_retries=0)
+        self.session = requests.Session()
+        self.session.mount("http://", self._adapter)
+        self.session.mount("https://", self._adapter)
+
+        self.breaker = CircuitBreaker() if breaker is True else breaker or None
+
     #def build_job(chan, action, properties):
         #def job():
             #time = datetime.datetime.now().isoformat()
-            ##print chan, action, properties 
+            ##print chan, action, properties
             #requests.post(CONFIG['url'] + str(chan),
                     #json = {'action': action, 'properties': properties, 'time': time },
                     #timeout=0.2)
         #return job
 
 
-
     def broadcast_multi(self, messages):
-        try:
-            time = datetime.datetime.now().isoformat()
-            for event in messages:
-                event['time'] = time
+        now = datetime.datetime.now().isoformat()
+        for event in messages:
+            event['time'] = now
 
-            requests.post(self.multi_events,
-                    json = {'messages': messages },
-                    timeout=0.2)
-        except Exception as e:
-            print e
+        self._put( (MULTI, messages) )
 
     def broadcast(self, chan, action, data):
+        data['time'] = datetime.datetime.now().isoformat()
+        data['action'] = action
+
+        self._put( (chan, data) )
+
+    def stats(self):
+        """ delivery counters and current queue depth """
+        stats = WorkerQueue.stats(self)
+        stats['connections'] = self.connection_stats()
+        stats['circuit'] = self.breaker.state if self.breaker else None
+        return stats
+
+    def connection_stats(self):
+        """ opened, reused and failed connections to the server """
+        opened, requested = 0, 0
+        pools = self._adapter.poolmanager.pools
+        for key in pools.keys():
+            pool = pools.get(key)
+            if pool is not None:
+                opened += pool.num_connections
+                requested += pool.num_requests
+        with self._lock:
+            failed = self._counters['errors']
+        return { 'opened': opened,
+                 'reused': max(requested - opened, 0),
+                 'failed': failed,
+               }
+
+    # delivery
 
+    def _put(self, job):
+        if self.workers <= 0 :
+            return self._deliver([job])
+
+        self._start()
         try:
-            time = datetime.datetime.now().isoformat()
-            data['time'] = time
-            data['action'] = action
-            requests.post(self.new_event + str(chan),
-                    json = data,
-                    timeout=0.2)
-        except Exception as e:
-            print e
+            self._queue.put_nowait(job)
+            self._count('queued')
+        except Full:
+            self._count('dropped')
+
+    def _size(self, job):
+        chan, data = job
+        return len(data) if chan is MULTI else 1
+
+    def _process(self, jobs):
+        self._deliver(jobs)
+
+    def _deliver(self, jobs):
+        """ posts the jobs in queue order, consecutive multi messages are merged """
+        messages = []
+        for chan, data in jobs:
+            if chan is MULTI:
+                messages.extend(data)
+            else:
+                # multi messages queued before go first
+                self._post_multi(messages)
+                messages = []
+                self._post(self.new_event + str(chan), data, 1)
+        self._post_multi(messages)
 
-        #th = threading.Thread(target=build_job(chan, action, properties))
-        #th.start()
+    def _post_multi(self, messages):
+        for i in xrange(0, len(messages), self.batch_size):
+            batch = messages[i:i+self.batch_size]
+            self._post(self.multi_events, {'messages': batch}, len(batch))
+
+    def _post(self, url, payload, count):
+        if self.breaker and not self.breaker.allow():
+            self._count('rejected', count)
+            return
+
+        try:
+            self.session.post(url, json=payload, timeout=self.timeout)
+            self._count('posts')
+            self._count('sent', count)
+            if self.breaker: self.breaker.success()
+        except Exception as e:
+            self._count('errors')
+            if self.breaker is None:
+                print e
+            elif self.breaker.failure():
+                print "notification server unreachable, retry in %ss" % self.breaker.cooldown, e
@@ -0,0 +1,199 @@
+#-*- coding:utf-8 -*-
+""" Write-behind aggregation of the graph up/down votes """
+
+import time
+import atexit
+import threading
+
+
+UP, DOWN = "up", "down"
+
+
+def toggled(vote, direction):
+    """ vote of a user after toggling `direction` """
+    return None if vote == direction else direction
+
+def vote_value(value):
+    """ up, down or None from a backend vote """
+    if isinstance(value, dict):
+        value = value.get('vote')
+    return value if value in (UP, DOWN) else None
+
+
+class VoteAggregator(object):
+    """ Applies vote toggles in memory and writes them to the graph db
+    by periodic batches.
+
+    The vote of a user is read from the db, then kept in memory for `ttl`
+    seconds, so that users read their own votes back before they are
+    flushed. Votes not flushed yet are kept until they are.
+    A flush reads the vote stored in the db again and only sends the toggles
+    needed to turn it into the last vote of the user, a burst of toggles
+    costs at most one db write, and votes written meanwhile by another
+    process are not toggled back.
+
+    :param load: function (username, gid) giving the vote stored in the db
+    :param toggle: function (username, gid, direction) toggling a vote in the db
+    :param interval: seconds between flushes, 0 to write synchronously
+    :param on_flush: function called with the gids written by a flush
+    :param max_votes: max number of flushed votes kept in memory
+    :param ttl: seconds a flushed vote is kept in memory
+    """
+
+    def __init__(self, load, toggle, interval=2., on_flush=None, max_votes=100000, ttl=60.):
+        self.load = load
+        self.toggle = toggle
+        self.interval = interval
+        self.on_flush = on_flush
+        self.max_votes = max_votes
+        self.ttl = ttl
+
+        self._votes = {}    # (username, gid) : (vote, db record, expiration time)
+        self._pending = {}  # (username, gid) : (vote before the change, time of first change)
+        self._lock = threading.RLock()
+        self._thread = None
+        self._counters = { 'toggles': 0, 'writes': 0, 'errors': 0, 'flushes': 0, 'last_flush_lag': 0. }
+
+        atexit.register(self.flush)
+
+    def vote(self, username, gid):
+        """ :returns: up, down or None """
+        return self._entry(username, gid)[0]
+
+    def record(self, username, gid):
+        """ :returns: the vote data last read from or written to the db """
+        return self._entry(username, gid)[1]
+
+    def _entry(self, username, gid):
+        key = (username, gid)
+        with self._lock:
+            entry = self._votes.get(key)
+            if entry is not None and (key in self._pending or entry[2] > time.time()):
+                return entry
+        record = self.load(username, gid)
+        with self._lock:
+            if key in self._pending and key in self._votes:
+                # toggled meanwhile
+                return self._votes[key]
+            if len(self._votes) >= self.max_votes:
+                self._forget()
+            entry = (vote_value(record), record, time.time() + self.ttl)
+            self._votes[key] = entry
+            return entry
+
+    def _forget(self):
+        """ drops the expired votes, all the flushed votes if still full """
+        now = time.time()
+        self._votes = dict( (k, e) for k, e in self._votes.iteritems() if k in self._pending or e[2] > now )
+        if len(self._votes) >= self.max_votes:
+            self._votes = dict( (k, e) for k, e in self._votes.iteritems() if k in self._pending )
+
+    def pending(self, gid):
+        """ :returns: { up: delta, down: delta } votes of `gid` not flushed yet """
+        counts = { UP: 0, DOWN: 0 }
+        with self._lock:
+            for (username, g), (stored, since) in self._pending.iteritems():
+                if g != gid: continue
+                vote = self._votes[(username, g)][0]
+                if stored : counts[stored] -= 1
+                if vote : counts[vote] += 1
+        return counts
+
+    def vote_toggle(self, username, gid, direction):
+        """ toggles the vote of a user
+        :returns: the new vote, up, down or None
+        """
+        if direction not in (UP, DOWN):
+            raise ValueError("unknown vote %s" % direction)
+        entry = self._entry(username, gid)
+        key = (username, gid)
+
+        with self._lock:
+            current, record, expires = self._votes.get(key, entry)
+            vote = toggled(current, direction)
+            self._votes[key] = (vote, record, expires)
+            self._counters['toggles'] += 1
+            if key not in self._pending:
+                self._pending[key] = (current, time.time())
+
+        if self.interval <= 0:
+            self.flush()
+        else :
+            self._start()
+        return vote
+
+    def flush(self):
+        """ writes the pending votes to the db """
+        with self._lock:
+            pending, self._pending = self._pending, {}
+            votes = dict( (key, self._votes[key][0]) for key in pending )
+        if not len(pending):
+            return
+
+        now = time.time()
+        lag = max( now - since for stored, since in pending.itervalues() )
+        failed, records = {}, {}
+        for key, (stored, since) in pending.iteritems():
+            username, gid = key
+            try:
+                # the db may have been written by another process since
+                record = self.load(username, gid)
+                for direction in self._toggles(vote_value(record), votes[key]):
+                    record = self.toggle(username, gid, direction)
+                    self._count('writes')
+                records[key] = record
+            except Exception as e:
+                print "vote flush failed", username, gid, e
+                self._count('errors')
+                failed[key] = (stored, since)
+
+        with self._lock:
+            # failures are retried with the next flush
+            self._pending.update(failed)
+            expires = time.time() + self.ttl
+            for key, record in records.iteritems():
+                if key not in self._pending:
+                    self._votes[key] = (votes[key], record, expires)
+            self._counters['flushes'] += 1
+            self._counters['last_flush_lag'] = lag
+
+        if self.on_flush:
+            self.on_flush(set( key[1] for key in pending ))
+
+    @staticmethod
+    def _toggles(stored, vote):
+        """ toggles turning the `stored` vote into `vote` """
+        if stored == vote:
+            return []
+        return [ stored if vote is None else vote ]
+
+    def stats(self):
+        """ counters, pending votes and flush lag, in seconds """
+        with self._lock:
+            stats = dict(self._counters)
+            stats['pending'] = len(self._pending)
+            stats['votes'] = len(self._votes)
+            oldest = min([ since for stored, since in self._pending.itervalues() ] or [None])
+        stats['flush_lag'] = time.time() - oldest if oldest else 0.
+        return stats
+
+    def _count(self, key, value=1):
+        with self._lock:
+            self._counters[key] += value
+
+    def _start(self):
+        if self._thread is not None and self._thread.is_alive():
+            return
+        with self._lock:
+            if self._thread is None or not self._thread.is_alive():
+                self._thread = threading.Thread(target=self._work, name="votes")
+                self._thread.daemon = True
+                self._thread.start()
+
+    def _work(self):
+        while True:
+            time.sleep(self.interval)
+            try:
+                self.flush()
+            except Exception as e:
+                print "vote flush failed", e
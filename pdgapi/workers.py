@@ -0,0 +1,85 @@
+#-*- coding:utf-8 -*-
+""" Bounded job queue processed by background worker threads """
+
+import threading
+
+from Queue import Queue, Empty
+
+
+class WorkerQueue(object):
+    """ Queue of jobs processed by batches in background threads,
+    started on first use.
+
+    Subclasses implement `_process`, called with a batch of jobs, and may
+    override `_size` to weight the jobs of a batch.
+
+    :param workers: number of threads
+    :param queue_size: max number of pending jobs
+    :param batch_size: max total size of the jobs of a batch
+    :param counters: initial values of the counters reported by `stats`
+    :param name: name prefix of the threads
+    """
+
+    def __init__(self, workers=1, queue_size=1000, batch_size=1, counters=None, name="worker"):
+        self.workers = workers
+        self.batch_size = batch_size
+        self.name = name
+
+        self._queue = Queue(maxsize=queue_size)
+        self._threads = []
+        self._lock = threading.Lock()
+        self._counters = dict(counters or {})
+
+    def stats(self):
+        """ counters, queue depth and number of live threads """
+        with self._lock:
+            stats = dict(self._counters)
+        stats['depth'] = self._queue.qsize()
+        stats['workers'] = len([ t for t in self._threads if t.is_alive() ])
+        return stats
+
+    def join(self):
+        """ block until every queued job has been processed """
+        if self.workers > 0:
+            self._queue.join()
+
+    def _count(self, key, value=1):
+        with self._lock:
+            self._counters[key] += value
+
+    def _start(self):
+        if len(self._threads) >= self.workers:
+            return
+        with self._lock:
+            while len(self._threads) < self.workers:
+                th = threading.Thread(target=self._work, name="%s-%s" % (self.name, len(self._threads)))
+                th.daemon = True
+                th.start()
+                self._threads.append(th)
+
+    def _work(self):
+        while True:
+            job = self._queue.get()
+            jobs = [ job ]
+            size = self._size(job)
+            # drain what is pending, up to batch_size
+            while size < self.batch_size:
+                try:
+                    job = self._queue.get_nowait()
+                except Empty:
+                    break
+                jobs.append(job)
+                size += self._size(job)
+            try:
+                self._process(jobs)
+            except Exception as e:
+                print "%s failed" % self.name, e
+            finally:
+                for job in jobs:
+                    self._queue.task_done()
+
+    def _size(self, job):
+        return 1
+
+    def _process(self, jobs):
+        raise NotImplementedError
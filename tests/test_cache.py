@@ -0,0 +1,146 @@
+#-*- coding:utf-8 -*-
+import os
+import time
+import shutil
+import tempfile
+import unittest
+
+from pdgapi.cache import LRUCache, GraphRevisions, DumpCache, CompletionIndex, CompletionIndexes, fold
+
+
+class LRUCacheTest(unittest.TestCase):
+
+    def test_size_accounting(self):
+        cache = LRUCache(max_size=10)
+        cache.set("a", "xxxx")
+        cache.set("b", "yyyy")
+        self.assertEqual(cache.size, 8)
+        # replacing a value accounts its new size only
+        cache.set("a", "xx")
+        self.assertEqual(cache.size, 6)
+        cache.pop("b")
+        self.assertEqual(cache.size, 2)
+        cache.clear()
+        self.assertEqual(cache.size, 0)
+
+    def test_evicts_least_recently_used(self):
+        cache = LRUCache(max_entries=2)
+        cache.set("a", 1, size=1)
+        cache.set("b", 2, size=1)
+        cache.get("a")
+        cache.set("c", 3, size=1)
+        self.assertEqual(sorted(cache.keys()), ["a", "c"])
+        self.assertEqual(cache.evictions, 1)
+        self.assertEqual(cache.size, 2)
+
+    def test_max_size(self):
+        cache = LRUCache(max_size=5)
+        cache.set("a", "xxx")
+        cache.set("b", "xxx")
+        self.assertEqual(cache.keys(), ["b"])
+        self.assertEqual(cache.size, 3)
+        self.assertFalse(cache.set("c", "x" * 6))
+        self.assertEqual(cache.keys(), ["b"])
+
+    def test_ttl(self):
+        cache = LRUCache(ttl=0.01)
+        cache.set("a", "xxx")
+        time.sleep(0.02)
+        self.assertIsNone(cache.get("a"))
+        self.assertEqual(cache.size, 0)
+        self.assertEqual(cache.misses, 1)
+
+    def test_discard(self):
+        cache = LRUCache()
+        cache.set(("g1", "json"), "xx")
+        cache.set(("g1", "pickle"), "xx")
+        cache.set(("g2", "json"), "xx")
+        cache.discard(lambda key: key[0] == "g1")
+        self.assertEqual(cache.keys(), [("g2", "json")])
+        self.assertEqual(cache.size, 2)
+
+
+class DumpCacheTest(unittest.TestCase):
+
+    def setUp(self):
+        self.path = tempfile.mkdtemp()
+        self.dumps = DumpCache(GraphRevisions(), max_size=100, path=self.path, buffer_size=10)
+
+    def tearDown(self):
+        shutil.rmtree(self.path)
+
+    def test_small_stream_is_kept_in_memory(self):
+        self.assertEqual("".join(self.dumps.stream("g", "json", ["abcd"] * 2)), "abcd" * 2)
+        self.assertEqual(len(self.dumps.memory), 1)
+        self.assertEqual(self.dumps.get("g", "json"), "abcd" * 2)
+
+    def test_large_stream_goes_to_disk(self):
+        self.assertEqual("".join(self.dumps.stream("g", "json", ["abcd"] * 20)), "abcd" * 20)
+        self.assertEqual(len(self.dumps.memory), 0)
+        self.assertEqual(self.dumps.get("g", "json"), "abcd" * 20)
+
+    def test_interrupted_stream_is_not_kept(self):
+        chunks = self.dumps.stream("g", "json", ["abcd"] * 20)
+        for i in range(5): next(chunks)
+        chunks.close()
+        self.assertIsNone(self.dumps.get("g", "json"))
+        self.assertEqual(os.listdir(self.dumps._directory()), [])
+
+    def test_outdated_stream_is_not_kept(self):
+        chunks = self.dumps.stream("g", "json", ["abcd"] * 20)
+        next(chunks)
+        self.dumps.revisions.bump("g")
+        list(chunks)
+        self.assertIsNone(self.dumps.get("g", "json"))
+
+
+def entry(uuid, label):
+    return { 'uuid': uuid, 'label': label }
+
+class CompletionIndexTest(unittest.TestCase):
+
+    def test_complete(self):
+        index = CompletionIndex([ entry("1", u"Paris"), entry("2", u"pâte"), entry("3", u"lyon") ], fold)
+        self.assertEqual([ e['uuid'] for e in index.complete(u"pa") ], ["1", "2"])
+        self.assertEqual([ e['uuid'] for e in index.complete(u"pa", start=1) ], ["2"])
+        self.assertEqual([ e['uuid'] for e in index.complete(u"", size=1) ], ["3"])
+
+    def test_upsert_remove(self):
+        index = CompletionIndex([ entry("1", u"paris") ])
+        index.upsert(entry("1", u"lyon"))
+        self.assertEqual(index.complete(u"pa"), [])
+        self.assertEqual(len(index), 1)
+        index.remove("1")
+        index.remove("1")
+        self.assertEqual((len(index), index.entries), (0, {}))
+
+    def test_index_size_follows_upserts(self):
+        indexes = CompletionIndexes(lambda gid, obj_type, limit: [ entry("1", u"a") ], None)
+        indexes.complete("g", "node", u"a")
+        self.assertEqual(indexes.indexes.size, 1)
+        indexes.refresh("g", "2", lambda obj_type: [ entry("2", u"b") ])
+        self.assertEqual(indexes.indexes.size, 2)
+        indexes.remove("g", "1")
+        self.assertEqual(indexes.indexes.size, 1)
+
+
+    def test_oversized_graphs_are_not_indexed(self):
+        loads, fallbacks = [], []
+        def loader(gid, obj_type, limit):
+            loads.append(gid)
+            return [ entry(str(i), u"a%s" % i) for i in range(limit + 1) ]
+        def fallback(gid, obj_type, prefix, start, size):
+            fallbacks.append(prefix)
+            return []
+        indexes = CompletionIndexes(loader, fallback, max_entries=10)
+        for prefix in (u"a", u"a1", u"a2"):
+            indexes.complete("g", "node", prefix)
+        self.assertEqual((loads, fallbacks), (["g"], [u"a", u"a1", u"a2"]))
+        self.assertEqual(len(indexes.indexes), 0)
+        indexes.invalidate("g")
+        indexes.complete("g", "node", u"a")
+        self.assertEqual(len(loads), 2)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,93 @@
+#-*- coding:utf-8 -*-
+import unittest
+
+try:
+    from pdgapi import columnar
+except ImportError:
+    columnar = None
+
+
+class Sequence(object):
+    """ vertex or edge sequence of `Graph` """
+
+    def __init__(self, attrs):
+        self.attrs = attrs
+
+    def attributes(self):
+        return list(self.attrs)
+
+    def __getitem__(self, attr):
+        return self.attrs[attr]
+
+class Graph(object):
+    """ the part of the igraph interface used by `columnar.dumps` """
+
+    def __init__(self, edges, vattrs, eattrs, gattrs):
+        self.edges = edges
+        self.vs = Sequence(vattrs)
+        self.es = Sequence(eattrs)
+        self.gattrs = gattrs
+
+    def get_edgelist(self):
+        return self.edges
+
+    def vcount(self):
+        return len(self.vs['uuid'])
+
+    def ecount(self):
+        return len(self.edges)
+
+    def is_directed(self):
+        return True
+
+    def attributes(self):
+        return list(self.gattrs)
+
+    def __getitem__(self, attr):
+        return self.gattrs[attr]
+
+
+@unittest.skipIf(columnar is None, "numpy is not installed")
+class ColumnarTest(unittest.TestCase):
+
+    def graph(self):
+        return Graph([(0, 1), (1, 2)],
+                     { 'uuid': [u"a", u"b", u"é"],
+                       'label': [u"A", None, u"Ç"],
+                       'score': [1, 2, 3],
+                       'size': [.5, 1, 2.],
+                       'flag': [True, False, True],
+                       'props': [{'x': 1}, [1, 2], u"s"] },
+                     { 'weight': [2., 3.],
+                       'type': [u"t1", u"t2"] },
+                     { 'name': u"graph", 'meta': object() })
+
+    def test_round_trip(self):
+        header, columns = columnar.load(columnar.dumps(self.graph()))
+
+        self.assertEqual((header['vcount'], header['ecount']), (3, 2))
+        self.assertTrue(header['directed'])
+        self.assertEqual(header['attributes']['name'], u"graph")
+        self.assertEqual(columns['edges'].tolist(), [[0, 1], [1, 2]])
+        self.assertEqual(columns['weights'].tolist(), [2., 3.])
+        self.assertEqual(list(columns['uuids']), [u"a", u"b", u"é"])
+        self.assertEqual(list(columns['vs.label']), [u"A", u"", u"Ç"])
+        self.assertEqual(columns['vs.score'].dtype.kind, 'i')
+        self.assertEqual(columns['vs.score'].tolist(), [1, 2, 3])
+        self.assertEqual(columns['vs.size'].tolist(), [.5, 1., 2.])
+        self.assertEqual(columns['vs.flag'].tolist(), [True, False, True])
+        self.assertEqual(list(columns['vs.props']), [{'x': 1}, [1, 2], u"s"])
+        self.assertEqual(list(columns['es.type']), [u"t1", u"t2"])
+        self.assertNotIn('es.weight', columns)
+
+    def test_blocks_are_aligned(self):
+        header, columns = columnar.load(columnar.dumps(self.graph()))
+        for block in header['blocks']:
+            self.assertEqual(block['offset'] % columnar.ALIGN, 0)
+
+    def test_not_columnar(self):
+        self.assertRaises(ValueError, columnar.load, bytearray(b"PDGCOL00" + b"\0" * 16))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,92 @@
+#-*- coding:utf-8 -*-
+import time
+import threading
+import unittest
+
+from pdgapi.executor import ProcessExecutor, ExecutorBusy, ExecutorTimeout, ExecutorError
+
+
+def square(x):
+    return x * x
+
+def sleep(seconds):
+    time.sleep(seconds)
+    return seconds
+
+def fail():
+    raise ValueError("failed")
+
+class Adder(object):
+    """ not picklable by reference, run by name """
+    def __init__(self, value):
+        self.value = value
+        self.lock = threading.Lock()
+
+    def __call__(self, x):
+        return x + self.value
+
+
+class ProcessExecutorTest(unittest.TestCase):
+
+    def setUp(self):
+        self.executor = ProcessExecutor(workers=1, max_queue=0, timeout=1.)
+
+    def tearDown(self):
+        self.executor._terminate()
+
+    def test_run(self):
+        self.assertEqual(self.executor.run(square, 3), 9)
+        self.executor.register("add", Adder(2))
+        self.assertEqual(self.executor.run("add", 3), 5)
+
+    def test_worker_is_reused(self):
+        self.executor.run(square, 1)
+        worker = self.executor._idle[0]
+        self.executor.run(square, 2)
+        self.assertEqual(self.executor._idle, [worker])
+        self.assertEqual(worker.tasks, 2)
+
+    def test_error(self):
+        with self.assertRaises(ExecutorError) as ctx:
+            self.executor.run(fail)
+        self.assertIn("ValueError", ctx.exception.trace)
+        self.assertEqual(self.executor.stats()['errors'], 1)
+
+    def test_timeout(self):
+        self.assertRaises(ExecutorTimeout, self.executor.run, sleep, 3)
+        self.assertEqual(self.executor.stats()['timeouts'], 1)
+        # a new pool takes over
+        self.assertEqual(self.executor.run(square, 4), 16)
+
+    def test_timeout_spares_other_calls(self):
+        executor = ProcessExecutor(workers=2, max_queue=0, timeout=1.)
+        results = []
+        def slow():
+            try:
+                executor.run(sleep, 3)
+            except ExecutorTimeout:
+                results.append("timeout")
+        worker = threading.Thread(target=slow)
+        worker.start()
+        time.sleep(.3)
+        try:
+            self.assertEqual(executor.run(sleep, .9), .9)
+        finally:
+            worker.join()
+            executor._terminate()
+        self.assertEqual(results, ["timeout"])
+
+    def test_busy(self):
+        worker = threading.Thread(target=self.executor.run, args=(sleep, .5))
+        worker.start()
+        time.sleep(.2)
+        try:
+            self.assertRaises(ExecutorBusy, self.executor.run, square, 2)
+        finally:
+            worker.join()
+        stats = self.executor.stats()
+        self.assertEqual((stats['calls'], stats['rejected'], stats['running']), (2, 1, 0))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,80 @@
+#-*- coding:utf-8 -*-
+import os
+import json
+import shutil
+import tempfile
+import unittest
+import contextlib
+
+try:
+    from pdgapi.mailer import MailDispatcher
+except ImportError:
+    MailDispatcher = None
+
+
+class App(object):
+    """ stands for the flask app """
+
+    @contextlib.contextmanager
+    def app_context(self):
+        yield
+
+class Message(object):
+
+    def __init__(self, recipient):
+        self.sender = "noreply@padagraph.io"
+        self.recipients = [recipient]
+        self.subject = "subject"
+        self.body = "body"
+
+
+@unittest.skipIf(MailDispatcher is None, "flask_mail is not installed")
+class MailDispatcherTest(unittest.TestCase):
+
+    def setUp(self):
+        self.path = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.path)
+
+    def spool(self, uuid, recipient, pid=None):
+        """ spools a mail as the process `pid` would, as older versions did without """
+        job = { 'id': uuid, 'time': 1, 'attempts': 0,
+                'mail': { 'sender': "s", 'recipients': [recipient], 'subject': "", 'body': "" } }
+        name = "1000-%s.json" % uuid if pid is None else "1000-%s.%s.json" % (uuid, pid)
+        with open(os.path.join(self.path, name), 'w') as f:
+            json.dump(job, f)
+
+    def test_send(self):
+        mailer = MailDispatcher(App(), None, sink="memory", path=self.path)
+        mailer.send(Message("a@b.c"))
+        mailer.join()
+        self.assertEqual([ m['recipients'] for m in mailer.outbox ], [["a@b.c"]])
+        self.assertEqual(os.listdir(self.path), [])
+        self.assertEqual(mailer.stats()['sent'], 1)
+
+    def test_synchronous(self):
+        mailer = MailDispatcher(App(), None, sink="memory", workers=0)
+        mailer.send(Message("a@b.c"))
+        self.assertEqual(len(mailer.outbox), 1)
+
+    def test_claims_mails_of_gone_processes(self):
+        # pid 1 is alive, its mail is left to it
+        self.spool("a", "alive@b.c", pid=1)
+        self.spool("b", "old@b.c")
+        mailer = MailDispatcher(App(), None, sink="memory", path=self.path)
+        mailer.join()
+        self.assertEqual([ m['recipients'] for m in mailer.outbox ], [["old@b.c"]])
+        self.assertEqual(os.listdir(self.path), ["1000-a.1.json"])
+
+    def test_failed_mails_are_kept(self):
+        mailer = MailDispatcher(App(), None, sink=os.path.join(self.path, "missing", "out"),
+                                path=self.path, retries=1)
+        mailer.send(Message("a@b.c"))
+        mailer.join()
+        self.assertEqual(mailer.stats()['failed'], 1)
+        self.assertEqual([ n.endswith(".failed") for n in os.listdir(self.path) if n != "missing" ], [True])
+
+
+if __name__ == '__main__':
+    unittest.main()
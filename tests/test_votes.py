@@ -0,0 +1,86 @@
+#-*- coding:utf-8 -*-
+import unittest
+
+from pdgapi.votes import VoteAggregator, toggled, vote_value, UP, DOWN
+
+
+class Backend(object):
+    """ in memory vote storage """
+
+    def __init__(self):
+        self.votes = {}
+        self.toggles = 0
+
+    def load(self, username, gid):
+        return { 'vote': self.votes.get((username, gid)), 'graph': gid }
+
+    def toggle(self, username, gid, direction):
+        self.toggles += 1
+        self.votes[(username, gid)] = toggled(self.votes.get((username, gid)), direction)
+        return self.load(username, gid)
+
+
+class VotesTest(unittest.TestCase):
+
+    def setUp(self):
+        self.db = Backend()
+        self.votes = VoteAggregator(self.db.load, self.db.toggle, interval=3600)
+
+    def test_toggled(self):
+        self.assertEqual(toggled(None, UP), UP)
+        self.assertEqual(toggled(UP, UP), None)
+        self.assertEqual(toggled(UP, DOWN), DOWN)
+        self.assertEqual(vote_value({'vote': DOWN}), DOWN)
+        self.assertEqual(vote_value("other"), None)
+
+    def test_toggles(self):
+        self.assertEqual(VoteAggregator._toggles(None, None), [])
+        self.assertEqual(VoteAggregator._toggles(None, UP), [UP])
+        self.assertEqual(VoteAggregator._toggles(UP, None), [UP])
+        self.assertEqual(VoteAggregator._toggles(UP, DOWN), [DOWN])
+
+    def test_burst_costs_one_write(self):
+        for direction in (UP, DOWN, UP, UP, DOWN):
+            self.votes.vote_toggle("u", "g", direction)
+        self.assertEqual(self.votes.vote("u", "g"), DOWN)
+        self.assertEqual(self.votes.pending("g"), { UP: 0, DOWN: 1 })
+        self.assertEqual(self.db.toggles, 0)
+        self.votes.flush()
+        self.assertEqual((self.db.votes[("u", "g")], self.db.toggles), (DOWN, 1))
+        self.assertEqual(self.votes.pending("g"), { UP: 0, DOWN: 0 })
+
+    def test_cancelled_vote_is_not_written(self):
+        self.votes.vote_toggle("u", "g", UP)
+        self.votes.vote_toggle("u", "g", UP)
+        self.votes.flush()
+        self.assertEqual(self.db.toggles, 0)
+
+    def test_flush_reads_the_db_again(self):
+        self.votes.vote_toggle("u", "g", UP)
+        # written by another process meanwhile
+        self.db.votes[("u", "g")] = UP
+        self.votes.flush()
+        self.assertEqual((self.db.votes[("u", "g")], self.db.toggles), (UP, 0))
+
+    def test_failed_flush_is_retried(self):
+        toggle = self.db.toggle
+        self.db.toggle = None
+        self.votes.toggle = lambda *args: self.db.toggle(*args)
+        self.votes.vote_toggle("u", "g", DOWN)
+        self.votes.flush()
+        self.assertEqual(self.votes.stats()['pending'], 1)
+        self.db.toggle = toggle
+        self.votes.flush()
+        self.assertEqual(self.db.votes[("u", "g")], DOWN)
+        self.assertEqual(self.votes.stats()['errors'], 1)
+
+    def test_flushed_votes_expire(self):
+        self.votes.ttl = 0
+        self.votes.vote_toggle("u", "g", UP)
+        self.votes.flush()
+        self.db.votes[("u", "g")] = DOWN
+        self.assertEqual(self.votes.vote("u", "g"), DOWN)
+
+
+if __name__ == '__main__':
+    unittest.main()